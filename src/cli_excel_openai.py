@@ -16,11 +16,12 @@ Uso:
 import argparse
 import os
 import sys
-from openai_excel_helper import OpenAIExcelProcessor, simple_excel_query, extract_structured_data
-from config import get_api_key
 
+# openai_excel_helper (y con él el SDK de OpenAI) se importa dentro de
+# cada modo: --help y los errores de argumentos no pagan ese costo
 
-def interactive_mode(processor: OpenAIExcelProcessor):
+
+def interactive_mode(processor: "OpenAIExcelProcessor"):
     """
     Modo interactivo para hacer múltiples consultas sobre el archivo.
     """
@@ -82,6 +83,8 @@ def single_query_mode(excel_path: str, api_key: str, query: str, model: str):
     """
     Modo de consulta única.
     """
+    from openai_excel_helper import simple_excel_query
+
     print(f"\nConsultando: {query}")
     print("-" * 80)
     
@@ -98,6 +101,8 @@ def structured_extraction_mode(excel_path: str, api_key: str, model: str):
     """
     Modo de extracción estructurada - ejemplo con schema predefinido.
     """
+    from openai_excel_helper import extract_structured_data
+
     print("\nExtrayendo datos estructurados del archivo...")
     print("-" * 80)
     
@@ -135,11 +140,15 @@ Analiza el archivo Excel y extrae la siguiente información:
 """
     
     result = extract_structured_data(api_key, excel_path, schema, instructions, model)
-    
+
     if result["success"]:
-        import json
         print("\nDatos extraídos:")
-        print(json.dumps(result["data"], indent=2, ensure_ascii=False))
+        try:
+            import orjson
+            print(orjson.dumps(result["data"], option=orjson.OPT_INDENT_2).decode())
+        except ImportError:
+            import json
+            print(json.dumps(result["data"], indent=2, ensure_ascii=False))
     else:
         print(f"\n❌ Error: {result['error']}")
 
@@ -213,6 +222,8 @@ Ejemplos de uso:
         print(f"⚠️  Advertencia: El archivo no tiene extensión .xlsx o .xls")
     
     # Obtener API key (desde argumento, .env, o variable de entorno)
+    from config import get_api_key
+
     api_key = get_api_key(args.api_key)
     
     if not api_key:
@@ -231,6 +242,8 @@ Ejemplos de uso:
     # Ejecutar según el modo seleccionado
     if args.interactive:
         # Modo interactivo
+        from openai_excel_helper import OpenAIExcelProcessor
+
         processor = OpenAIExcelProcessor(api_key, args.model)
         try:
             processor.upload_excel_file(args.excel_file)
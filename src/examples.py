@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Ejemplos de uso del procesador de Excel con OpenAI
+==================================================
+Demos sueltas que antes vivían (inalcanzables) al final de main.py:
+consultas múltiples con contexto, extracción estructurada y el flujo
+estilo distri_hub. Se ejecutan llamando la función deseada desde abajo.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def run_all_examples(excel_path: str = "datos.xlsx"):
+    """
+    Corre las consultas de los ejemplos en UNA sola petición: el Excel se
+    serializa una vez y las tareas van numeradas en el mismo prompt, con
+    response_format json_object para poder repartir la respuesta por
+    tarea. Evita pagar subida + ida y vuelta por cada ejemplo.
+    """
+    from openai_excel_helper import OpenAIExcelProcessor
+    from config import get_api_key
+
+    print("\n" + "="*80)
+    print("EJEMPLOS COMBINADOS: una sola petición multi-tarea")
+    print("="*80)
+
+    API_KEY = get_api_key()
+    if not API_KEY:
+        print("❌ Error: No se encontró API_KEY. Configúrala en .env o como variable de entorno.")
+        return
+
+    processor = OpenAIExcelProcessor(API_KEY, model="gpt-4o")
+
+    tareas = [
+        "Dame un resumen general del contenido del archivo",
+        "¿Cuáles son las columnas más importantes?",
+        "¿Hay algún dato faltante o inconsistente?",
+    ]
+
+    csv_content, num_rows, num_cols, columns, content_note = \
+        processor._excel_csv_info(excel_path)
+
+    task_lines = "\n".join(f"{i}) {tarea}" for i, tarea in enumerate(tareas, 1))
+    full_prompt = f"""Analiza el siguiente archivo Excel que tiene {num_rows} filas y {num_cols} columnas.
+Columnas: {', '.join(str(c) for c in columns)}
+
+Contenido del archivo (formato CSV):
+```
+{csv_content}
+```
+{content_note}
+
+Responde cada una de las siguientes tareas numeradas. Devuelve ÚNICAMENTE un
+objeto JSON con una clave "task_N" (texto de la respuesta) por cada tarea:
+
+{task_lines}
+"""
+
+    result = processor.query_prepared_prompt(
+        full_prompt, temperature=0.3,
+        response_format={"type": "json_object"}
+    )
+
+    if not result["success"]:
+        print(f"❌ Error: {result['error']}")
+        return
+
+    try:
+        respuestas = json.loads(result["response"])
+    except json.JSONDecodeError as e:
+        print(f"❌ La respuesta no es un JSON válido: {e}")
+        print(result["response"])
+        return
+
+    for i, tarea in enumerate(tareas, 1):
+        print(f"\n{i}. {tarea}")
+        print("-" * 80)
+        print(respuestas.get(f"task_{i}", "(sin respuesta)"))
+
+    print(f"\n[Tokens usados: {result['total_tokens']}]")
+
+
+def ejemplo_multiples_consultas():
+    """
+    Ejemplo 2: Múltiples consultas manteniendo el contexto
+    """
+    from openai_excel_helper import OpenAIExcelProcessor
+    from config import get_api_key
+
+    print("\n" + "="*80)
+    print("EJEMPLO 2: Múltiples Consultas con Contexto")
+    print("="*80)
+    
+    # Obtener API key desde .env o variable de entorno
+    API_KEY = get_api_key()
+    if not API_KEY:
+        print("❌ Error: No se encontró API_KEY. Configúrala en .env o como variable de entorno.")
+        return
+    
+    excel_path = "datos.xlsx"
+    
+    # Crear un procesador
+    processor = OpenAIExcelProcessor(API_KEY, model="gpt-4o")
+    
+    # Subir el archivo (solo una vez)
+    file_id = processor.upload_excel_file(excel_path)
+    print(f"Archivo subido con ID: {file_id}")
+    
+    # Primera consulta
+    result1 = processor.query_excel(
+        "Dame un resumen general del contenido del archivo"
+    )
+    if result1["success"]:
+        print(f"\n1. {result1['response']}\n")
+    
+    # Segunda consulta (mantiene el contexto)
+    result2 = processor.query_excel(
+        "¿Cuáles son las columnas más importantes?"
+    )
+    if result2["success"]:
+        print(f"\n2. {result2['response']}\n")
+    
+    # Tercera consulta (sigue manteniendo el contexto)
+    result3 = processor.query_excel(
+        "¿Hay algún dato faltante o inconsistente?"
+    )
+    if result3["success"]:
+        print(f"\n3. {result3['response']}\n")
+    
+    # Ver el historial completo
+    print("\n" + "-"*80)
+    print("Historial de conversación:")
+    print("-"*80)
+    for msg in processor.get_conversation_history():
+        print(f"\n{msg['role'].upper()}: {msg['content'][:100]}...")
+
+
+def ejemplo_extraccion_estructurada():
+    """
+    Ejemplo 3: Extracción de datos estructurados según un schema
+    """
+    from openai_excel_helper import extract_structured_data
+    from config import get_api_key
+
+    print("\n" + "="*80)
+    print("EJEMPLO 3: Extracción de Datos Estructurados")
+    print("="*80)
+    
+    # Obtener API key desde .env o variable de entorno
+    API_KEY = get_api_key()
+    if not API_KEY:
+        print("❌ Error: No se encontró API_KEY. Configúrala en .env o como variable de entorno.")
+        return
+    
+    excel_path = "datos.xlsx"
+    
+    # Definir el schema de datos que queremos extraer
+    schema = {
+        "type": "object",
+        "required": ["productos", "total_ventas", "fecha_reporte"],
+        "properties": {
+            "productos": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "nombre": {"type": "string"},
+                        "cantidad": {"type": "integer"},
+                        "precio": {"type": "number"}
+                    }
+                }
+            },
+            "total_ventas": {
+                "type": "number",
+                "description": "Suma total de todas las ventas"
+            },
+            "fecha_reporte": {
+                "type": "string",
+                "description": "Fecha del reporte en formato YYYY-MM-DD"
+            }
+        }
+    }
+    
+    instructions = """
+Analiza este archivo Excel de ventas y extrae:
+- Lista de productos con nombre, cantidad y precio
+- Total de ventas
+- Fecha del reporte (si está disponible)
+
+Asegúrate de que el JSON cumpla con el schema proporcionado.
+"""
+    
+    result = extract_structured_data(
+        api_key=API_KEY,
+        excel_path=excel_path,
+        schema=schema,
+        instructions=instructions
+    )
+    
+    if result["success"]:
+        print("\nDatos extraídos:")
+        print(json.dumps(result["data"], indent=2, ensure_ascii=False))
+    else:
+        print(f"Error: {result['error']}")
+
+
+def ejemplo_uso_similar_distri_hub():
+    """
+    Ejemplo 4: Uso similar al de cli_radicacion.py de Distri-Hub
+    Procesamiento con reintentos y validación
+    """
+    from openai_excel_helper import OpenAIExcelProcessor, extract_structured_data
+    from config import get_api_key
+
+    print("\n" + "="*80)
+    print("EJEMPLO 4: Uso Similar a Distri-Hub (con reintentos)")
+    print("="*80)
+    
+    # Obtener API key desde .env o variable de entorno
+    API_KEY = get_api_key()
+    if not API_KEY:
+        print("❌ Error: No se encontró API_KEY. Configúrala en .env o como variable de entorno.")
+        return
+    
+    excel_path = "facturas.xlsx"
+    
+    processor = OpenAIExcelProcessor(API_KEY)
+    
+    # Definir schema para validación (similar al médico)
+    schema = {
+        "type": "object",
+        "required": ["facturas_validas", "facturas_invalidas"],
+        "properties": {
+            "facturas_validas": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "numero_factura": {"type": "string"},
+                        "nit_cliente": {"type": "string"},
+                        "valor": {"type": "number"}
+                    }
+                }
+            },
+            "facturas_invalidas": {
+                "type": "array",
+                "items": {"type": "string"}
+            }
+        }
+    }
+    
+    instructions = """
+Analiza el archivo de facturas y clasifícalas en:
+- Facturas válidas: tienen número, NIT y valor
+- Facturas inválidas: les falta algún dato
+
+Devuelve SOLO el JSON según el schema.
+"""
+    
+    # Intentos especulativos en paralelo: en vez de encadenar hasta 3
+    # reintentos (cada uno espera la ida y vuelta completa), se disparan
+    # los 3 a la vez y gana el primero que traiga facturas válidas. El
+    # procesador compartido hace que el Excel se serialice una sola vez.
+    attempts = 3
+    data = None
+
+    print(f"\nDisparando {attempts} intentos especulativos en paralelo...")
+    with ThreadPoolExecutor(max_workers=attempts) as ex:
+        futs = [
+            ex.submit(
+                extract_structured_data,
+                api_key=API_KEY,
+                excel_path=excel_path,
+                schema=schema,
+                instructions=instructions,
+                processor=processor
+            )
+            for _ in range(attempts)
+        ]
+
+        for fut in as_completed(futs):
+            try:
+                result = fut.result()
+            except Exception as e:
+                print(f"✗ Error en el intento: {str(e)}")
+                continue
+
+            if not result["success"]:
+                print(f"✗ Error: {result['error']}")
+                continue
+
+            candidate = result["data"]
+            if len(candidate.get("facturas_validas", [])) > 0:
+                print("✓ Extracción exitosa")
+                data = candidate
+                # Cancelar lo que aún no haya arrancado
+                for other in futs:
+                    if other is not fut:
+                        other.cancel()
+                break
+            print("⚠ Intento sin facturas válidas, esperando a los demás...")
+
+    
+    if data:
+        print("\n" + "-"*80)
+        print("RESULTADO FINAL:")
+        print("-"*80)
+        print(json.dumps(data, indent=2, ensure_ascii=False))
+        print(f"\nFacturas válidas: {len(data['facturas_validas'])}")
+        print(f"Facturas inválidas: {len(data['facturas_invalidas'])}")
+    else:
+        print("\n✗ No se pudo procesar el archivo después de varios intentos")
+
+
+if __name__ == "__main__":
+    run_all_examples()
@@ -6,12 +6,379 @@ Este ejemplo muestra cómo integrar el procesamiento de Excel
 en un flujo de trabajo similar al de Distri-Hub.
 """
 
+import asyncio
+import hashlib
+import json
+import logging
 import os
+from pathlib import Path
+from dataclasses import dataclass
+import queue
+import random
+import re
+import threading
 import time
 from typing import Dict, Any, List, Optional
-from openai_excel_helper import OpenAIExcelProcessor, extract_structured_data
+
+import openai
+
+try:
+    # Serializador C (~3-5x más rápido que json stdlib para dicts anidados)
+    import orjson
+except ImportError:
+    orjson = None
+
+from openai_excel_helper import (
+    OpenAIExcelProcessor,
+    _build_structured_prompt,
+    _parse_structured_response,
+)
 from config import get_api_key
 
+# Un solo logger con un solo handler: bajo concurrencia alta evita la
+# contención del lock de stdout que generaban los print() por archivo
+log = logging.getLogger("radication")
+
+
+def _dump_json_file(path: str, data: Any, fsync: bool = False):
+    """
+    Escribe un JSON indentado en disco de forma atómica: primero a un
+    .tmp y luego os.replace(), así un crash a mitad de escritura nunca
+    deja un JSON corrupto que obligue a re-procesar.
+    Usa orjson (un solo write de bytes, encoder en C) si está disponible;
+    si no, cae al json de la librería estándar.
+
+    Args:
+        path: Ruta del archivo de salida
+        data: Datos a serializar
+        fsync: Si es True, fuerza el flush a disco (para checkpoints
+               que deben sobrevivir un crash)
+    """
+    target = Path(path)
+    tmp = target.with_name(target.name + ".tmp")
+
+    if orjson is not None:
+        with open(tmp, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+    else:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    tmp.replace(target)
+
+
+def _writer_loop(write_q: "queue.Queue"):
+    """
+    Consumidor único de escrituras de salida. Serializar todas las
+    escrituras en un hilo evita la contención de metadata/journal del
+    filesystem cuando muchos resultados terminan a la vez, y el loop
+    principal no se bloquea en el fsync de cada checkpoint.
+    """
+    while True:
+        item = write_q.get()
+        try:
+            if item is None:
+                return
+            path, data = item
+            _dump_json_file(path, data, fsync=True)
+        except Exception as e:
+            log.error(f"✗ Error escribiendo {item[0]}: {e}")
+        finally:
+            write_q.task_done()
+
+
+def _retry_delay(attempt: int, error: Optional[Exception] = None) -> float:
+    """
+    Calcula la espera antes del siguiente reintento.
+
+    Backoff exponencial con tope de 60s más jitter aleatorio para evitar
+    tormentas de reintentos cuando varios archivos fallan a la vez.
+    Si el error es un 429 de OpenAI, respeta el header `retry-after`
+    enviado por el servidor en lugar de despertar antes de tiempo.
+
+    Args:
+        attempt: Número de reintento (1 para el primero)
+        error: Excepción que causó el reintento, si la hay
+
+    Returns:
+        Segundos a esperar
+    """
+    # 1s, 2s, 4s, ... con tope de 60s
+    delay = min(60, 2 ** max(0, attempt - 1))
+
+    if isinstance(error, openai.RateLimitError):
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+
+    return delay + random.uniform(0, 1)
+
+
+class AsyncTokenBucket:
+    """
+    Token bucket asíncrono para limitar peticiones por minuto.
+
+    A diferencia del semáforo (que solo acota las peticiones en vuelo),
+    el bucket reparte las peticiones de forma uniforme en el tiempo, lo
+    que evita las ráfagas de 429 al inicio de cada lote. Los tokens se
+    reponen de forma continua a max_rate / time_period por segundo.
+    """
+
+    def __init__(self, max_rate: int, time_period: float = 60.0):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._tokens = float(max_rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Espera (sin bloquear el event loop) hasta obtener un token."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    float(self.max_rate),
+                    self._tokens + (now - self._updated) * self.max_rate / self.time_period
+                )
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) * self.time_period / self.max_rate
+                await asyncio.sleep(wait)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+@dataclass(slots=True)
+class _Job:
+    """
+    Metadatos por archivo calculados una sola vez antes del loop caliente:
+    evita repetir basename/splitext/exists por cada uso del mismo archivo.
+    """
+    path: str
+    basename: str
+    stem: str
+    valid: bool
+
+
+# Mismo patrón que declara el schema: chequeo en C por fila, sin
+# materializar listas intermedias solo para contarlas
+_MD_CODE_RE = re.compile(r"^MD[0-9]{6}$")
+
+# Versión del prompt: editar las instrucciones/schema debe invalidar el caché
+PROMPT_VERSION = "v1"
+
+# TTL del caché local de extracciones (7 días)
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# Schema para validar la respuesta de extracción de medicamentos
+MEDICINE_SCHEMA = {
+    "type": "object",
+    "required": ["medicamentos"],
+    "properties": {
+        "medicamentos": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["principio_activo", "concentracion", "codigo_md"],
+                "properties": {
+                    "principio_activo": {
+                        "type": "string"
+                    },
+                    "concentracion": {
+                        "type": "string"
+                    },
+                    "codigo_md": {
+                        "type": "string",
+                        "pattern": "^MD[0-9]{6}$"
+                    }
+                }
+            }
+        }
+    }
+}
+
+MEDICINE_INSTRUCTIONS = """
+El Excel contiene medicamentos con principio activo y concentración.
+Para cada medicamento busca el código MD más similar (rango MD000001 a MD999999).
+
+Reglas sobre concentraciones:
+- Escrituras distintas pueden ser equivalentes: "6.5mg" = "6.500000mg", "0.5g" = "500mg".
+- Una suma como "6.5mg + 2.5mg" NO es 9mg: busca un producto con AMBAS concentraciones por separado.
+- Cuida decimales, unidades (mg, g, ml) y ceros insignificantes.
+- Con varios principios activos separados por "+", cada uno tiene su propia concentración.
+
+Responde SOLO el JSON, sin explicaciones:
+{"medicamentos": [{"principio_activo": "...", "concentracion": "...", "codigo_md": "MDxxxxxx"}]}
+"""
+
+
+# Encabezados que identifican las columnas útiles para la extracción
+_RELEVANT_HEADER_KEYWORDS = (
+    "principio", "concentraci", "medicamento", "descripcion",
+    "descripción", "codigo", "código", "producto"
+)
+
+
+def _extract_medicamento_rows(path: str) -> Optional[str]:
+    """
+    Lee el Excel en modo streaming (openpyxl read_only) y devuelve un CSV
+    compacto solo con las columnas relevantes para la extracción.
+
+    El modo read_only mantiene la memoria acotada sin importar el tamaño
+    del workbook, y recortar a las columnas útiles reduce los tokens del
+    prompt frente a mandar la hoja completa.
+
+    Args:
+        path: Ruta al archivo .xlsx
+
+    Returns:
+        CSV con las columnas relevantes, o None si no se pudieron
+        identificar (el llamador debe caer al contenido completo)
+    """
+    import csv
+    import io
+
+    try:
+        from openpyxl import load_workbook
+
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            rows = ws.iter_rows(values_only=True)
+
+            header = next(rows, None)
+            if not header:
+                return None
+
+            # Identificar las columnas relevantes por encabezado
+            wanted = [
+                i for i, h in enumerate(header)
+                if h is not None and any(
+                    kw in str(h).lower() for kw in _RELEVANT_HEADER_KEYWORDS
+                )
+            ]
+
+            if not wanted:
+                return None
+
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow([header[i] for i in wanted])
+
+            for row in rows:
+                values = [
+                    row[i] if i < len(row) and row[i] is not None else ""
+                    for i in wanted
+                ]
+                if any(v != "" for v in values):
+                    writer.writerow(values)
+
+            return buffer.getvalue()
+        finally:
+            wb.close()
+
+    except Exception as e:
+        log.warning(f"⚠ No se pudo leer {path} en modo streaming: {e}")
+        return None
+
+
+def _prompt_fingerprint() -> str:
+    """
+    Huella del prompt derivada del schema + instrucciones: cualquier
+    edición invalida el caché automáticamente, sin depender de que
+    alguien recuerde subir PROMPT_VERSION.
+    """
+    return hashlib.sha256(
+        (json.dumps(MEDICINE_SCHEMA, sort_keys=True) + MEDICINE_INSTRUCTIONS).encode('utf-8')
+    ).hexdigest()[:12]
+
+
+_PROMPT_HASH = _prompt_fingerprint()
+
+# La extracción es un pattern-match estrecho (principio activo -> MDxxxxxx):
+# un modelo pequeño la resuelve bien y mucho más barato. Si falla la
+# validación de schema dos veces, se escala al modelo grande.
+DEFAULT_MODEL = "gpt-4o-mini"
+FALLBACK_MODEL = "gpt-4o"
+_SCHEMA_FAILURES_BEFORE_FALLBACK = 2
+
+# Tope de tokens de salida: la lista de medicamentos es acotada y esto
+# evita que el modelo divague
+_MAX_COMPLETION_TOKENS = 4096
+
+# response_format con el schema: el modelo devuelve JSON validado por la
+# API, sin vueltas de reintento por errores de formato
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "extraccion_medicamentos",
+        "schema": MEDICINE_SCHEMA
+    }
+}
+
+# Validador del schema compilado UNA vez al importar; el costo de compilar
+# se paga por proceso, no por archivo-por-reintento
+try:
+    import fastjsonschema
+    _MED_VALIDATOR = fastjsonschema.compile(MEDICINE_SCHEMA)
+except ImportError:
+    try:
+        import jsonschema
+
+        _draft_validator = jsonschema.Draft202012Validator(MEDICINE_SCHEMA)
+
+        def _MED_VALIDATOR(data):
+            _draft_validator.validate(data)
+    except ImportError:
+        _MED_VALIDATOR = None
+
+
+def _validate_medicamentos(data: Dict[str, Any]) -> Optional[str]:
+    """
+    Valida la respuesta del modelo contra MEDICINE_SCHEMA.
+
+    Returns:
+        None si es válida, o un mensaje describiendo el problema
+    """
+    if _MED_VALIDATOR is not None:
+        try:
+            _MED_VALIDATOR(data)
+            return None
+        except Exception as e:
+            return str(e)
+
+    # Fallback sin jsonschema instalado: chequear los códigos MD con el
+    # mismo patrón que declara el schema
+    invalid_count = sum(
+        1 for m in data.get("medicamentos", [])
+        if not _MD_CODE_RE.match(m.get("codigo_md", ""))
+    )
+
+    if invalid_count:
+        return f"{invalid_count} códigos MD inválidos"
+
+    return None
+
 
 class ExcelRadicationProcessor:
     """
@@ -19,23 +386,205 @@ class ExcelRadicationProcessor:
     Similar al flujo de cli_radicacion.py pero para Excel.
     """
     
-    def __init__(self, api_key: str, model: str = "gpt-4o"):
+    def __init__(self, api_key: str, model: str = DEFAULT_MODEL,
+                 cache_dir: Optional[str] = ".extraction_cache"):
         self.api_key = api_key
         self.model = model
         self.processor = OpenAIExcelProcessor(api_key, model)
-        
+        self.cache_dir = cache_dir
+        # Prompt de extracción estructurada pre-construido una sola vez;
+        # el schema no viaja en el texto, lo garantiza _RESPONSE_FORMAT
+        self.structured_prompt = _build_structured_prompt(MEDICINE_INSTRUCTIONS)
+
+    def _cache_path(self, excel_path: str) -> str:
+        """
+        Calcula la ruta de caché para un archivo Excel.
+        La clave es sha256(bytes del archivo) + versión del prompt + modelo,
+        así que editar el prompt o cambiar de modelo invalida el caché.
+        """
+        with open(excel_path, 'rb') as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+
+        return os.path.join(
+            self.cache_dir,
+            f"{content_hash}_{PROMPT_VERSION}_{_PROMPT_HASH}_{self.model}.json"
+        )
+
+    def _cache_get(self, excel_path: str) -> Optional[Dict[str, Any]]:
+        """
+        Devuelve el resultado cacheado para el archivo, o None si no hay
+        entrada vigente (no existe o expiró el TTL de 7 días).
+        """
+
+        if self.cache_dir is None:
+            # Caché desactivado (--no-cache)
+            return None
+
+        try:
+            cache_path = self._cache_path(excel_path)
+
+            if not os.path.exists(cache_path):
+                return None
+
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+
+            if entry.get("expiresAt", 0) < time.time():
+                return None
+
+            return entry.get("data")
+
+        except Exception:
+            # Un caché corrupto nunca debe romper el procesamiento
+            return None
+
+    def _cache_put(self, excel_path: str, data: Dict[str, Any]):
+        """Guarda el resultado en el caché de forma atómica (write + os.replace)."""
+
+        if self.cache_dir is None:
+            return
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            cache_path = self._cache_path(excel_path)
+
+            entry = {
+                "data": data,
+                "promptVersion": PROMPT_VERSION,
+                "model": self.model,
+                "expiresAt": time.time() + CACHE_TTL_SECONDS
+            }
+
+            tmp_path = cache_path + ".tmp"
+            if orjson is not None:
+                # Un solo write de bytes ya serializados, sin indentación
+                with open(tmp_path, 'wb') as f:
+                    f.write(orjson.dumps(entry))
+            else:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+
+        except Exception as e:
+            log.warning(f"⚠ No se pudo escribir el caché para {excel_path}: {e}")
+
     def validate_excel_file(self, excel_path: str) -> bool:
-        """Valida que el archivo Excel existe y es válido."""
+        """
+        Valida que el archivo Excel existe y es válido.
+        Además de la extensión, chequea los magic bytes localmente: un CSV
+        renombrado o un zip corrupto se rechaza en microsegundos, antes de
+        pagar la llamada a la API y sus reintentos.
+        """
         if not os.path.exists(excel_path):
-            print(f"❌ Error: Archivo no encontrado: {excel_path}")
+            log.error(f"❌ Error: Archivo no encontrado: {excel_path}")
             return False
         
         if not excel_path.lower().endswith(('.xlsx', '.xls')):
-            print(f"❌ Error: El archivo debe ser Excel (.xlsx o .xls)")
+            log.error(f"❌ Error: El archivo debe ser Excel (.xlsx o .xls)")
             return False
-        
+
+        try:
+            with open(excel_path, 'rb') as f:
+                magic = f.read(4)
+        except OSError as e:
+            log.error(f"❌ Error: No se pudo leer {excel_path}: {e}")
+            return False
+
+        # xlsx es un zip (PK\x03\x04); xls es un contenedor OLE2
+        if magic not in (b'PK\x03\x04', b'\xd0\xcf\x11\xe0'):
+            log.error(f"❌ Error: {excel_path} no tiene formato Excel válido "
+                  f"(magic bytes {magic!r}); ¿archivo renombrado o corrupto?")
+            return False
+
         return True
-    
+
+    def _prevalidate(self, excel_files: List[str]) -> tuple:
+        """
+        Pre-pasa de validación local antes de emitir cualquier llamada a
+        la API: existencia, extensión, magic bytes y un sondeo barato de
+        apertura con openpyxl. Así un lote con archivos rotos falla rápido
+        en O(N) lecturas locales en vez de quemar créditos y reintentos.
+
+        Args:
+            excel_files: Rutas a validar
+
+        Returns:
+            Tupla (good, bad) donde bad es una lista de (ruta, razón)
+        """
+        good = []
+        bad = []
+
+        for path in excel_files:
+            if not self.validate_excel_file(path):
+                bad.append((path, "no existe o formato/magic bytes inválidos"))
+                continue
+
+            if path.lower().endswith('.xlsx'):
+                try:
+                    from openpyxl import load_workbook
+
+                    wb = load_workbook(path, read_only=True)
+                    _ = wb.sheetnames
+                    wb.close()
+                except Exception as e:
+                    log.error(f"❌ Error: openpyxl no puede abrir {path}: {e}")
+                    bad.append((path, f"openpyxl no puede abrirlo: {e}"))
+                    continue
+
+            good.append(path)
+
+        return good, bad
+
+    def _pick_model(self, schema_failures: int) -> str:
+        """
+        Elige el modelo para el próximo intento: el configurado mientras
+        venga respondiendo bien, y el de fallback después de
+        _SCHEMA_FAILURES_BEFORE_FALLBACK fallos de validación seguidos.
+        """
+        if (
+            schema_failures >= _SCHEMA_FAILURES_BEFORE_FALLBACK
+            and self.model != FALLBACK_MODEL
+        ):
+            log.warning(f"⚠ Escalando al modelo de fallback: {FALLBACK_MODEL}")
+            return FALLBACK_MODEL
+
+        return self.model
+
+    def _build_medicine_prompt(self, excel_path: str) -> str:
+        """
+        Construye el mensaje de usuario para la extracción: solo el
+        contenido del archivo. Las reglas y el schema viajan en el mensaje
+        system (self.structured_prompt), que es byte-idéntico entre
+        llamadas para que el prompt caching de OpenAI pueda descontarlo.
+
+        Primero intenta el camino compacto: streaming con openpyxl y solo
+        las columnas relevantes. Si no se identifican los encabezados (o el
+        archivo es .xls), cae al contenido completo vía pandas.
+
+        Args:
+            excel_path: Ruta al archivo Excel
+
+        Returns:
+            Mensaje de usuario listo para enviar al modelo
+        """
+        csv_content = None
+        if excel_path.lower().endswith('.xlsx'):
+            csv_content = _extract_medicamento_rows(excel_path)
+
+        if csv_content is None:
+            # Fallback: contenido completo vía pandas (con tope de filas)
+            import pandas as pd
+
+            df = pd.read_excel(excel_path)
+            if len(df) > 5000:
+                df = df.head(5000)
+            csv_content = df.to_csv(index=False)
+
+        return (
+            f"Extrae los medicamentos del siguiente archivo Excel (CSV):\n"
+            f"```\n{csv_content}\n```"
+        )
+
     def extract_medicine_codes_from_excel(
         self, 
         excel_path: str, 
@@ -52,90 +601,47 @@ class ExcelRadicationProcessor:
         Returns:
             Diccionario con los códigos extraídos o None si falla
         """
-        
-        # Schema para validar la respuesta
-        schema = {
-            "type": "object",
-            "required": ["medicamentos"],
-            "properties": {
-                "medicamentos": {
-                    "type": "array",
-                    "minItems": 1,
-                    "items": {
-                        "type": "object",
-                        "required": ["principio_activo", "concentracion", "codigo_md"],
-                        "properties": {
-                            "principio_activo": {
-                                "type": "string"
-                            },
-                            "concentracion": {
-                                "type": "string"
-                            },
-                            "codigo_md": {
-                                "type": "string",
-                                "pattern": "^MD[0-9]{6}$"
-                            }
-                        }
-                    }
-                }
-            }
-        }
-        
-        instructions = """
-Analiza el archivo Excel que contiene medicamentos con principios activos y concentraciones.
-
-Para cada medicamento, debes buscar el código MD más similar del rango MD000001 a MD999999.
-
-IMPORTANTE - CONCENTRACIONES:
-1. Las concentraciones pueden estar escritas de diferentes formas pero ser equivalentes:
-   - "6.5mg" es equivalente a "6.500000mg"
-   - "0.5g" es equivalente a "500mg"
-   
-2. Cuando hay concentraciones como suma (ej: "6.5mg + 2.5mg"):
-   - NO significa buscar la suma (9mg)
-   - Significa buscar un producto que tenga AMBAS concentraciones: 6.5mg Y 2.5mg
-   - El producto debe tener exactamente esas dos concentraciones por separado
-
-3. Presta ESPECIAL atención a:
-   - Los números decimales (6.5 vs 6.500000 son iguales)
-   - Las unidades de medida (mg, g, ml, etc.)
-   - Los ceros insignificantes
-   
-4. Si hay múltiples principios activos separados por "+", cada uno tiene su concentración.
-
-FORMATO DE RESPUESTA:
-Devuelve SOLO un JSON con este formato exacto:
-{
-  "medicamentos": [
-    {
-      "principio_activo": "nombre del principio activo del excel",
-      "concentracion": "concentración exacta del excel",
-      "codigo_md": "MDxxxxxx"
-    }
-  ]
-}
+        # Caché exacto: mismo contenido + mismo prompt + mismo modelo
+        # devuelve el resultado guardado sin ninguna llamada a la API
+        cached = self._cache_get(excel_path)
+        if cached is not None:
+            log.info(f"✓ Resultado obtenido del caché para: {excel_path}")
+            return cached
 
-El código_md debe estar en el rango MD000001 a MD999999.
-NO agregues explicaciones, SOLO el JSON.
-"""
-        
         current_try = 0
         data = None
-        
-        print(f"\n{'='*80}")
-        print(f"Procesando archivo: {excel_path}")
-        print(f"{'='*80}\n")
-        
+
+        log.debug(f"{'='*80}")
+        log.debug(f"Procesando archivo: {excel_path}")
+        log.debug(f"{'='*80}")
+
+        # Construir el prompt (lee y serializa el Excel) UNA sola vez;
+        # los reintentos reusan el mismo prompt ya preparado
+        try:
+            full_prompt = self._build_medicine_prompt(excel_path)
+        except Exception as e:
+            log.error(f"✗ Error leyendo {excel_path}: {e}")
+            return {"medicamentos": []}
+
+        schema_failures = 0
+        empty_retries = 0
+
         while max_retries > current_try:
             try:
-                print(f"Intento {current_try + 1}/{max_retries}...")
-                
-                result = extract_structured_data(
-                    api_key=self.api_key,
-                    excel_path=excel_path,
-                    schema=schema,
-                    instructions=instructions,
-                    model=self.model
+                log.debug(f"Intento {current_try + 1}/{max_retries}...")
+
+                model = self._pick_model(schema_failures)
+
+                result = _parse_structured_response(
+                    self.processor.query_prepared_prompt(
+                        full_prompt,
+                        temperature=0.0,
+                        model=model,
+                        max_tokens=_MAX_COMPLETION_TOKENS,
+                        response_format=_RESPONSE_FORMAT,
+                        system=self.structured_prompt
+                    ),
+                    model
                 )
                 
                 if result["success"]:
@@ -144,130 +650,767 @@ NO agregues explicaciones, SOLO el JSON.
                     # Validar que haya al menos un medicamento válido
                     medicamentos = data.get("medicamentos", [])
                     if len(medicamentos) > 0:
-                        print(f"✓ Extracción exitosa: {len(medicamentos)} medicamentos encontrados")
-                        
-                        # Validar códigos MD
-                        invalid_codes = [
-                            m["principio_activo"] 
-                            for m in medicamentos 
-                            if not (m.get("codigo_md", "").startswith("MD") and len(m.get("codigo_md", "")) == 8)
-                        ]
+                        log.info(f"✓ Extracción exitosa: {len(medicamentos)} medicamentos encontrados")
                         
-                        if invalid_codes:
-                            print(f"⚠ Advertencia: {len(invalid_codes)} códigos MD inválidos, reintentando...")
+                        # Validar contra el schema compilado
+                        schema_error = _validate_medicamentos(data)
+
+                        if schema_error:
+                            log.warning(f"⚠ Advertencia: respuesta no cumple el schema ({schema_error}), reintentando...")
+                            schema_failures += 1
                             current_try += 1
-                            time.sleep(2)
+                            time.sleep(_retry_delay(current_try))
                             continue
                         
                         break
                     else:
-                        print("⚠ No se encontraron medicamentos válidos, reintentando...")
+                        # Un resultado vacío casi siempre es un problema de
+                        # contenido, no transitorio: un solo reintento con el
+                        # prompt reforzado y después fail-fast
+                        if empty_retries > 0:
+                            log.warning("⚠ Sin medicamentos por segunda vez; no se reintenta más")
+                            break
+
+                        log.warning("⚠ No se encontraron medicamentos, reintentando una vez con prompt reforzado...")
+                        empty_retries += 1
+                        schema_failures += 1
+                        full_prompt += (
+                            "\nIMPORTANTE: el intento anterior no devolvió "
+                            "medicamentos; revisa TODAS las filas del archivo."
+                        )
                         current_try += 1
-                        time.sleep(2)
+                        time.sleep(_retry_delay(current_try))
                         continue
                 else:
-                    print(f"✗ Error en la extracción: {result.get('error', 'Desconocido')}")
+                    log.error(f"✗ Error en la extracción: {result.get('error', 'Desconocido')}")
                     current_try += 1
-                    time.sleep(2)
+                    time.sleep(_retry_delay(current_try))
                     continue
                     
             except Exception as e:
-                print(f"✗ Error en el intento: {str(e)}")
+                log.error(f"✗ Error en el intento: {str(e)}")
                 current_try += 1
-                time.sleep(2)
+                time.sleep(_retry_delay(current_try, e))
         
         if not data:
-            print(f"\n✗ No se pudo procesar el archivo después de {max_retries} intentos")
+            log.error(f"✗ No se pudo procesar el archivo después de {max_retries} intentos")
             # Valores por defecto
             data = {
                 "medicamentos": []
             }
-            print("⚠ Usando datos por defecto vacíos")
-        
+            log.warning("⚠ Usando datos por defecto vacíos")
+        elif data.get("medicamentos"):
+            # Solo cachear extracciones con resultados válidos
+            self._cache_put(excel_path, data)
+
         return data
-    
-    def process_multiple_excel_files(
-        self, 
+
+    async def extract_medicine_codes_from_excel_async(
+        self,
+        excel_path: str,
+        max_retries: int = 3,
+        client: Optional["openai.AsyncOpenAI"] = None,
+        limiter: Optional[AsyncTokenBucket] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Variante asíncrona de extract_medicine_codes_from_excel.
+        Cada extracción es una llamada independiente a la API, por lo que
+        varios archivos pueden procesarse en paralelo con asyncio.gather.
+
+        Args:
+            excel_path: Ruta al archivo Excel
+            max_retries: Número máximo de intentos
+            client: Cliente AsyncOpenAI compartido (opcional)
+            limiter: Token bucket global de RPM compartido (opcional)
+
+        Returns:
+            Diccionario con los códigos extraídos o None si falla
+        """
+        # Caché exacto: mismo contenido + mismo prompt + mismo modelo
+        cached = self._cache_get(excel_path)
+        if cached is not None:
+            log.info(f"✓ Resultado obtenido del caché para: {excel_path}")
+            return cached
+
+        current_try = 0
+        schema_failures = 0
+        empty_retries = 0
+        data = None
+
+        log.debug(f"{'='*80}")
+        log.debug(f"Procesando archivo: {excel_path}")
+        log.debug(f"{'='*80}")
+
+        # Construir el prompt (lee y serializa el Excel) UNA sola vez;
+        # los reintentos reusan el mismo prompt ya preparado
+        try:
+            full_prompt = self._build_medicine_prompt(excel_path)
+        except Exception as e:
+            log.error(f"✗ Error leyendo {excel_path}: {e}")
+            return {"medicamentos": []}
+
+        while max_retries > current_try:
+            try:
+                log.debug(f"Intento {current_try + 1}/{max_retries}...")
+
+                if limiter is not None:
+                    await limiter.acquire()
+
+                model = self._pick_model(schema_failures)
+
+                result = _parse_structured_response(
+                    await self.processor.query_prepared_prompt_async(
+                        full_prompt,
+                        temperature=0.0,
+                        client=client,
+                        model=model,
+                        max_tokens=_MAX_COMPLETION_TOKENS,
+                        response_format=_RESPONSE_FORMAT,
+                        system=self.structured_prompt
+                    ),
+                    model
+                )
+
+                if result["success"]:
+                    data = result["data"]
+
+                    # Validar que haya al menos un medicamento válido
+                    medicamentos = data.get("medicamentos", [])
+                    if len(medicamentos) > 0:
+                        log.info(f"✓ Extracción exitosa: {len(medicamentos)} medicamentos encontrados")
+
+                        # Validar contra el schema compilado
+                        schema_error = _validate_medicamentos(data)
+
+                        if schema_error:
+                            log.warning(f"⚠ Advertencia: respuesta no cumple el schema ({schema_error}), reintentando...")
+                            schema_failures += 1
+                            current_try += 1
+                            await asyncio.sleep(_retry_delay(current_try))
+                            continue
+
+                        break
+                    else:
+                        # Un resultado vacío casi siempre es un problema de
+                        # contenido, no transitorio: un solo reintento con el
+                        # prompt reforzado y después fail-fast
+                        if empty_retries > 0:
+                            log.warning("⚠ Sin medicamentos por segunda vez; no se reintenta más")
+                            break
+
+                        log.warning("⚠ No se encontraron medicamentos, reintentando una vez con prompt reforzado...")
+                        empty_retries += 1
+                        schema_failures += 1
+                        full_prompt += (
+                            "\nIMPORTANTE: el intento anterior no devolvió "
+                            "medicamentos; revisa TODAS las filas del archivo."
+                        )
+                        current_try += 1
+                        await asyncio.sleep(_retry_delay(current_try))
+                        continue
+                else:
+                    log.error(f"✗ Error en la extracción: {result.get('error', 'Desconocido')}")
+                    current_try += 1
+                    await asyncio.sleep(_retry_delay(current_try))
+                    continue
+
+            except Exception as e:
+                log.error(f"✗ Error en el intento: {str(e)}")
+                current_try += 1
+                await asyncio.sleep(_retry_delay(current_try, e))
+
+        if not data:
+            log.error(f"✗ No se pudo procesar el archivo después de {max_retries} intentos")
+            # Valores por defecto
+            data = {
+                "medicamentos": []
+            }
+            log.warning("⚠ Usando datos por defecto vacíos")
+        elif data.get("medicamentos"):
+            # Solo cachear extracciones con resultados válidos
+            self._cache_put(excel_path, data)
+
+        return data
+
+    async def _extract_one(
+        self,
+        excel_file: str,
+        client: "openai.AsyncOpenAI",
+        sem: asyncio.Semaphore,
+        limiter: Optional[AsyncTokenBucket] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Extrae un archivo ya validado, respetando el semáforo de concurrencia."""
+        # El semáforo limita las peticiones en vuelo para no disparar
+        # 429s por ráfagas de RPM/TPM antes de saturar el throughput
+        async with sem:
+            return await self.extract_medicine_codes_from_excel_async(
+                excel_file, client=client, limiter=limiter
+            )
+
+    async def _extract_all(
+        self,
+        excel_files: List[str],
+        max_concurrency: int = 10,
+        rpm: int = 0
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Despacha todas las extracciones de forma concurrente, acotadas por
+        un semáforo de max_concurrency peticiones en vuelo y, si rpm > 0,
+        por un token bucket global que reparte las peticiones en el tiempo.
+        Reusa un único cliente AsyncOpenAI para evitar el handshake
+        TCP/TLS por cada petición.
+        """
+        client = openai.AsyncOpenAI(api_key=self.api_key)
+        sem = asyncio.Semaphore(max_concurrency)
+        limiter = AsyncTokenBucket(rpm) if rpm > 0 else None
+        try:
+            tasks = [self._extract_one(f, client, sem, limiter) for f in excel_files]
+            return await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            await client.close()
+
+    def extract_medicines_batched(
+        self,
+        paths: List[str],
+        batch_size: int = 10,
+        max_rows_per_batch: int = 500
+    ) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Extrae medicamentos de varios archivos pequeños por petición.
+        En lugar de pagar el bloque de instrucciones (~800 tokens) una vez
+        por archivo, concatena varios archivos en un solo prompt y pide
+        un JSON con los resultados por archivo, amortizando el overhead.
+
+        Los lotes se arman por presupuesto de filas además del número de
+        archivos: un archivo inesperadamente grande cierra el lote en vez
+        de inflar el prompt más allá del contexto.
+
+        Args:
+            paths: Lista de rutas a archivos Excel
+            batch_size: Máximo de archivos por petición (5-20 recomendado)
+            max_rows_per_batch: Máximo de filas acumuladas por petición
+
+        Returns:
+            Diccionario ruta -> datos extraídos ({"medicamentos": [...]}) o None
+        """
+        import pandas as pd
+
+        results: Dict[str, Optional[Dict[str, Any]]] = {}
+        client = openai.OpenAI(api_key=self.api_key)
+
+        # Armar lotes de forma voraz: cerrar el lote al alcanzar
+        # batch_size archivos o max_rows_per_batch filas acumuladas
+        batches = []
+        current: List[tuple] = []  # (file_id, path, csv_content)
+        current_rows = 0
+
+        for path in paths:
+            if not self.validate_excel_file(path):
+                results[path] = None
+                continue
+
+            try:
+                df = pd.read_excel(path)
+                csv_content = df.to_csv(index=False)
+                num_rows = len(df)
+            except Exception as e:
+                log.error(f"✗ Error leyendo {path}: {e}")
+                results[path] = None
+                continue
+
+            if current and (
+                len(current) >= batch_size
+                or current_rows + num_rows > max_rows_per_batch
+            ):
+                batches.append(current)
+                current = []
+                current_rows = 0
+
+            current.append((os.path.basename(path), path, csv_content))
+            current_rows += num_rows
+
+        if current:
+            batches.append(current)
+
+        for batch in batches:
+            # Construir las secciones por archivo, etiquetadas con su file_id
+            file_ids = {file_id: path for file_id, path, _ in batch}
+            sections = [
+                f"### ARCHIVO: {file_id}\n```\n{csv_content}\n```"
+                for file_id, _, csv_content in batch
+            ]
+
+            full_prompt = f"""{MEDICINE_INSTRUCTIONS}
+
+Se incluyen {len(sections)} archivos Excel, cada uno precedido por su identificador.
+Aplica las instrucciones anteriores a CADA archivo por separado.
+
+{chr(10).join(sections)}
+
+FORMATO DE RESPUESTA PARA MÚLTIPLES ARCHIVOS:
+Devuelve SOLO un JSON con este formato exacto, una entrada por archivo:
+{{
+  "results": {{
+    "<identificador del archivo>": {{"medicamentos": [...]}}
+  }}
+}}
+NO agregues explicaciones, SOLO el JSON.
+"""
+
+            log.info(f"📦 Petición combinada con {len(sections)} archivos...")
+
+            # Mismos kwargs que la extracción por archivo: temperature 0,
+            # tope de salida y schema forzado vía response_format. El
+            # schema se arma por lote: un MEDICINE_SCHEMA por file_id
+            # dentro de "results", así la API valida también el reparto.
+            batch_schema = {
+                "type": "object",
+                "properties": {
+                    "results": {
+                        "type": "object",
+                        "properties": {
+                            file_id: MEDICINE_SCHEMA for file_id in file_ids
+                        },
+                        "required": list(file_ids)
+                    }
+                },
+                "required": ["results"]
+            }
+            batch_response_format = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "extraccion_medicamentos_lote",
+                    "schema": batch_schema
+                }
+            }
+
+            try:
+                response = client.chat.completions.create(
+                    **self.processor._completion_kwargs(
+                        full_prompt, 0.0, self.model,
+                        min(_MAX_COMPLETION_TOKENS * len(batch), 16384),
+                        batch_response_format
+                    )
+                )
+
+                content = response.choices[0].message.content
+                parsed = _parse_structured_response(
+                    {"success": True, "response": content}, self.model
+                )
+
+                per_file = (parsed.get("data") or {}).get("results", {}) if parsed["success"] else {}
+
+            except Exception as e:
+                log.error(f"✗ Error en la petición combinada: {e}")
+                per_file = {}
+
+            # Repartir la respuesta entre los archivos del lote
+            for file_id, path in file_ids.items():
+                results[path] = per_file.get(file_id)
+
+        return results
+
+    def submit_batch(self, excel_files: List[str]) -> Optional[str]:
+        """
+        Envía todos los archivos como un único job a la Batch API de OpenAI.
+        La Batch API cuesta 50% menos que el endpoint en tiempo real, usa un
+        pool de rate limits separado y garantiza completarse en <24h: ideal
+        para corridas nocturnas de radicación con miles de archivos.
+
+        El contenido de cada Excel se inserta como texto en el prompt (igual
+        que en la ruta en tiempo real), una línea JSONL por archivo con
+        custom_id = ruta del archivo.
+
+        Args:
+            excel_files: Lista de rutas a archivos Excel
+
+        Returns:
+            ID del batch creado, o None si no hay archivos válidos
+        """
+        import tempfile
+
+        lines = []
+        for excel_file in excel_files:
+            if not self.validate_excel_file(excel_file):
+                continue
+
+            try:
+                full_prompt = self._build_medicine_prompt(excel_file)
+            except Exception as e:
+                log.error(f"✗ Error leyendo {excel_file}: {e}")
+                continue
+
+            # Mismos kwargs que la llamada en tiempo real (sin la escalada
+            # de modelo): temperature 0, schema forzado vía response_format
+            # y reglas en el mensaje system, para que los resultados del
+            # batch se parseen y validen igual que los online
+            lines.append({
+                "custom_id": excel_file,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self.processor._completion_kwargs(
+                    full_prompt, 0.0, self.model, _MAX_COMPLETION_TOKENS,
+                    _RESPONSE_FORMAT, system=self.structured_prompt
+                )
+            })
+
+        if not lines:
+            log.error("❌ No hay archivos válidos para enviar al batch.")
+            return None
+
+        client = openai.OpenAI(api_key=self.api_key)
+
+        # Escribir el JSONL de entrada y subirlo con purpose="batch"
+        with tempfile.NamedTemporaryFile(
+            mode='wb', suffix='.jsonl', delete=False
+        ) as f:
+            if orjson is not None:
+                f.write(b'\n'.join(orjson.dumps(line) for line in lines) + b'\n')
+            else:
+                for line in lines:
+                    f.write(json.dumps(line, ensure_ascii=False).encode('utf-8') + b'\n')
+            jsonl_path = f.name
+
+        try:
+            with open(jsonl_path, 'rb') as f:
+                input_file = client.files.create(file=f, purpose="batch")
+
+            batch = client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+        finally:
+            os.remove(jsonl_path)
+
+        log.info(f"✓ Batch enviado: {batch.id} ({len(lines)} archivos)")
+        return batch.id
+
+    def wait_for_batch(
+        self,
+        batch_id: str,
+        poll_interval: int = 5,
+        max_poll_interval: int = 300
+    ) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Espera a que un batch termine y devuelve los resultados parseados.
+        El intervalo de sondeo crece exponencialmente (5s, 10s, 20s...)
+        hasta max_poll_interval: responde rápido a batches cortos sin
+        martillar la API durante los de horas.
+
+        Args:
+            batch_id: ID del batch a esperar
+            poll_interval: Segundos iniciales entre consultas de estado
+            max_poll_interval: Tope del intervalo de sondeo
+
+        Returns:
+            Diccionario custom_id (ruta del archivo) -> datos extraídos o None
+        """
+
+        client = openai.OpenAI(api_key=self.api_key)
+
+        delay = poll_interval
+        while True:
+            batch = client.batches.retrieve(batch_id)
+            log.info(f"Estado del batch {batch_id}: {batch.status}")
+
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+
+            time.sleep(delay)
+            delay = min(max_poll_interval, delay * 2)
+
+        results = {}
+
+        if batch.status != "completed" or not batch.output_file_id:
+            log.error(f"✗ El batch terminó con estado: {batch.status}")
+            return results
+
+        output_content = client.files.content(batch.output_file_id).text
+
+        for raw_line in output_content.splitlines():
+            if not raw_line.strip():
+                continue
+
+            line = json.loads(raw_line)
+            custom_id = line.get("custom_id")
+
+            response_body = (line.get("response") or {}).get("body") or {}
+            choices = response_body.get("choices") or []
+
+            if not choices:
+                results[custom_id] = None
+                continue
+
+            content = choices[0]["message"]["content"]
+            parsed = _parse_structured_response(
+                {"success": True, "response": content}, self.model
+            )
+
+            results[custom_id] = parsed["data"] if parsed["success"] else None
+
+        return results
+
+    def process_multiple_excel_files_batch(
+        self,
         excel_files: List[str],
         output_dir: str = "output"
     ) -> Dict[str, Any]:
         """
-        Procesa múltiples archivos Excel.
-        Similar al loop en cli_radicacion.py
-        
+        Procesa múltiples archivos Excel vía la Batch API (modo offline).
+        Misma salida que process_multiple_excel_files pero con 50% de
+        descuento y turnaround de hasta 24 horas.
+
         Args:
             excel_files: Lista de rutas a archivos Excel
             output_dir: Directorio para guardar resultados
-            
+
         Returns:
             Diccionario con estadísticas del procesamiento
         """
-        
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        
+
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+
         total_processed = 0
         total_medicamentos = 0
         failed_files = []
-        
-        print(f"\n{'='*80}")
-        print(f"Procesando {len(excel_files)} archivos Excel")
-        print(f"{'='*80}\n")
-        
-        for idx, excel_file in enumerate(excel_files, 1):
-            print(f"\n[{idx}/{len(excel_files)}] Procesando: {os.path.basename(excel_file)}")
-            print("-" * 80)
-            
-            if not self.validate_excel_file(excel_file):
+
+        log.debug(f"{'='*80}")
+        log.info(f"Procesando {len(excel_files)} archivos Excel (Batch API)")
+        log.debug(f"{'='*80}")
+
+        batch_id = self.submit_batch(excel_files)
+
+        if batch_id is None:
+            return {
+                "total_files": len(excel_files),
+                "processed": 0,
+                "total_medicines": 0,
+                "failed_files": list(excel_files)
+            }
+
+        batch_results = self.wait_for_batch(batch_id)
+
+        for excel_file in excel_files:
+            data = batch_results.get(excel_file)
+
+            # basename/stem calculados una sola vez por archivo
+            name = os.path.basename(excel_file)
+            stem = os.path.splitext(name)[0]
+
+            log.info(f"Resultado de: {name}")
+            log.debug("-" * 80)
+
+            if data and len(data.get("medicamentos", [])) > 0:
+                medicamentos = data["medicamentos"]
+                total_medicamentos += len(medicamentos)
+
+                output_file = os.path.join(output_dir, f"{stem}_processed.json")
+
+                _dump_json_file(output_file, data)
+
+                log.info(f"✓ Guardado en: {output_file}")
+                log.info(f"  - Medicamentos procesados: {len(medicamentos)}")
+
+                total_processed += 1
+            else:
+                log.warning(f"⚠ No se pudieron extraer datos del archivo")
                 failed_files.append(excel_file)
+
+        log.debug(f"{'='*80}")
+        log.info("RESUMEN DEL PROCESAMIENTO (BATCH)")
+        log.debug(f"{'='*80}")
+        log.info(f"Archivos procesados exitosamente: {total_processed}/{len(excel_files)}")
+        log.info(f"Total de medicamentos procesados: {total_medicamentos}")
+        log.info(f"Archivos con errores: {len(failed_files)}")
+
+        return {
+            "total_files": len(excel_files),
+            "processed": total_processed,
+            "total_medicines": total_medicamentos,
+            "failed_files": failed_files
+        }
+
+    def process_multiple_excel_files(
+        self,
+        excel_files: List[str],
+        output_dir: str = "output",
+        max_concurrency: int = 10,
+        combine_batch_size: int = 0,
+        rpm: int = 0
+    ) -> Dict[str, Any]:
+        """
+        Procesa múltiples archivos Excel.
+        Las extracciones se despachan de forma concurrente con asyncio.gather,
+        ya que cada una es una llamada independiente a la API de OpenAI
+        (el tiempo total deja de escalar linealmente con el número de archivos).
+
+        Args:
+            excel_files: Lista de rutas a archivos Excel
+            output_dir: Directorio para guardar resultados
+            max_concurrency: Máximo de peticiones simultáneas a la API
+            combine_batch_size: Si es > 0, combina esa cantidad de archivos
+                                pequeños por petición para amortizar el
+                                costo del bloque de instrucciones
+            rpm: Si es > 0, límite global de peticiones por minuto
+
+        Returns:
+            Diccionario con estadísticas del procesamiento
+        """
+
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+        total_processed = 0
+        total_medicamentos = 0
+        failed_files = []
+
+        # Pre-validación local completa (existencia, magic bytes, apertura
+        # con openpyxl) ANTES de emitir cualquier llamada a la API
+        good, bad = self._prevalidate(excel_files)
+        good_set = set(good)
+
+        for path, reason in bad:
+            log.error(f"✗ {path} descartado en pre-validación: {reason}")
+
+        # Metadatos por archivo calculados UNA vez (basename/stem/validez);
+        # el resto del método solo lee atributos
+        jobs = []
+        for f in excel_files:
+            basename = os.path.basename(f)
+            jobs.append(_Job(
+                path=f,
+                basename=basename,
+                stem=os.path.splitext(basename)[0],
+                valid=f in good_set
+            ))
+
+        # Reanudación idempotente: los archivos que ya tienen su
+        # *_processed.json en output_dir no se vuelven a procesar
+        done = {
+            fn[:-len('_processed.json')]
+            for fn in os.listdir(output_dir)
+            if fn.endswith('_processed.json')
+        }
+        pending = [j for j in jobs if j.stem not in done]
+        skipped = len(jobs) - len(pending)
+
+        if skipped:
+            log.info(f"⏭️  Omitiendo {skipped} archivos ya procesados en {output_dir}")
+
+        log.debug(f"{'='*80}")
+        log.info(f"Procesando {len(pending)} archivos Excel (concurrente)")
+        log.debug(f"{'='*80}")
+
+        # Solo los archivos válidos llegan a la API (validación ya hecha arriba)
+        valid_paths = [j.path for j in pending if j.valid]
+
+        # Dedup por contenido: archivos byte-idénticos (globs con symlinks,
+        # re-descargas) se procesan una sola vez y el resultado se reparte
+        # a todas las rutas del grupo
+        hash_by_path: Dict[str, str] = {}
+        representative: Dict[str, str] = {}
+        for path in valid_paths:
+            try:
+                with open(path, 'rb') as fh:
+                    content_hash = hashlib.sha256(fh.read()).hexdigest()
+            except OSError as e:
+                log.warning(f"⚠ No se pudo leer {path} para dedup: {e}")
+                content_hash = path  # sin hash, se procesa individualmente
+            hash_by_path[path] = content_hash
+            representative.setdefault(content_hash, path)
+
+        unique_paths = list(representative.values())
+        duplicates = len(valid_paths) - len(unique_paths)
+        if duplicates:
+            log.info(f"🔁 {duplicates} archivos duplicados detectados; "
+                  f"se procesan {len(unique_paths)} únicos")
+
+        if combine_batch_size > 0:
+            # Archivos pequeños: varios por petición para amortizar el prompt
+            results_by_unique = self.extract_medicines_batched(unique_paths, combine_batch_size)
+        else:
+            # Despachar todas las extracciones en paralelo (acotadas por semáforo)
+            all_data = asyncio.run(self._extract_all(unique_paths, max_concurrency, rpm))
+            results_by_unique = dict(zip(unique_paths, all_data))
+
+        # Fan-out: cada ruta toma el resultado de su representante
+        results_by_path = {
+            path: results_by_unique.get(representative[hash_by_path[path]])
+            for path in valid_paths
+        }
+
+        # Hilo escritor único: las escrituras (con fsync) se encolan y no
+        # bloquean el loop de resultados
+        write_q: "queue.Queue" = queue.Queue()
+        writer = threading.Thread(target=_writer_loop, args=(write_q,), daemon=True)
+        writer.start()
+
+        # Escritura de resultados de forma síncrona una vez completado el gather
+        for job in pending:
+            log.info(f"Resultado de: {job.basename}")
+            log.debug("-" * 80)
+
+            if not job.valid:
+                failed_files.append(job.path)
                 continue
-            
+
+            data = results_by_path.get(job.path)
+
+            if isinstance(data, Exception):
+                log.error(f"✗ Error procesando archivo: {str(data)}")
+                failed_files.append(job.path)
+                continue
+
+            if data is None:
+                log.warning(f"⚠ No se pudieron extraer datos del archivo")
+                failed_files.append(job.path)
+                continue
+
             try:
-                # Extraer datos
-                data = self.extract_medicine_codes_from_excel(excel_file)
-                
-                if data and len(data.get("medicamentos", [])) > 0:
+                if len(data.get("medicamentos", [])) > 0:
                     medicamentos = data["medicamentos"]
                     total_medicamentos += len(medicamentos)
-                    
-                    # Guardar resultado
-                    import json
-                    output_file = os.path.join(
-                        output_dir, 
-                        f"{os.path.splitext(os.path.basename(excel_file))[0]}_processed.json"
-                    )
-                    
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        json.dump(data, f, indent=2, ensure_ascii=False)
-                    
-                    print(f"✓ Guardado en: {output_file}")
-                    print(f"  - Medicamentos procesados: {len(medicamentos)}")
-                    
+
+                    # Guardar resultado (checkpoint: fsync para poder reanudar)
+                    output_file = os.path.join(output_dir, f"{job.stem}_processed.json")
+
+                    write_q.put((output_file, data))
+
+                    log.info(f"✓ Guardado en: {output_file}")
+                    log.info(f"  - Medicamentos procesados: {len(medicamentos)}")
+
                     total_processed += 1
                 else:
-                    print(f"⚠ No se pudieron extraer datos del archivo")
-                    failed_files.append(excel_file)
-                
+                    log.warning(f"⚠ No se pudieron extraer datos del archivo")
+                    failed_files.append(job.path)
+
             except Exception as e:
-                print(f"✗ Error procesando archivo: {str(e)}")
-                failed_files.append(excel_file)
+                log.error(f"✗ Error procesando archivo: {str(e)}")
+                failed_files.append(job.path)
         
+        # Drenar la cola antes del resumen: todo checkpoint en disco
+        write_q.join()
+        write_q.put(None)
+        writer.join()
+
         # Resumen final
-        print(f"\n{'='*80}")
-        print("RESUMEN DEL PROCESAMIENTO")
-        print(f"{'='*80}")
-        print(f"Archivos procesados exitosamente: {total_processed}/{len(excel_files)}")
-        print(f"Total de medicamentos procesados: {total_medicamentos}")
-        print(f"Archivos con errores: {len(failed_files)}")
-        
+        log.debug(f"{'='*80}")
+        log.info("RESUMEN DEL PROCESAMIENTO")
+        log.debug(f"{'='*80}")
+        log.info(f"Archivos procesados exitosamente: {total_processed}/{len(pending)}")
+        log.info(f"Archivos omitidos (ya procesados): {skipped}")
+        log.info(f"Total de medicamentos procesados: {total_medicamentos}")
+        log.info(f"Archivos con errores: {len(failed_files)}")
+
         if failed_files:
-            print("\nArchivos fallidos:")
+            log.info("Archivos fallidos:")
             for f in failed_files:
-                print(f"  - {os.path.basename(f)}")
-        
+                log.info(f"  - {os.path.basename(f)}")
+
         return {
             "total_files": len(excel_files),
             "processed": total_processed,
+            "skipped": skipped,
             "total_medicines": total_medicamentos,
             "failed_files": failed_files
         }
@@ -293,8 +1436,8 @@ def main():
     )
     parser.add_argument(
         "--model",
-        default="gpt-4o",
-        help="Modelo de OpenAI (default: gpt-4o)"
+        default=DEFAULT_MODEL,
+        help=f"Modelo de OpenAI (default: {DEFAULT_MODEL})"
     )
     parser.add_argument(
         "--output-dir",
@@ -307,37 +1450,103 @@ def main():
         default=3,
         help="Número máximo de reintentos (default: 3)"
     )
-    
+    parser.add_argument(
+        "--max-concurrency",
+        "--concurrency",
+        type=int,
+        default=10,
+        help="Máximo de peticiones simultáneas a la API (default: 10)"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Usar la Batch API de OpenAI (50%% más barato, hasta 24h de espera)"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=".extraction_cache",
+        help="Directorio del caché de extracciones (default: .extraction_cache)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Desactivar el caché de extracciones"
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        help="Límite global de peticiones por minuto (default: 0 = sin límite)"
+    )
+    parser.add_argument(
+        "--combine",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Combinar N archivos pequeños por petición para amortizar el prompt (default: 0 = desactivado)"
+    )
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Solo advertencias y errores"
+    )
+    verbosity.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Salida detallada (incluye banners y progreso por intento)"
+    )
+
     args = parser.parse_args()
+
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose:
+        level = logging.DEBUG
+    else:
+        level = logging.INFO
+
+    logging.basicConfig(level=level, format="%(asctime)s %(message)s")
     
     # Obtener API key (desde argumento, .env, o variable de entorno)
     api_key = get_api_key(args.api_key)
     
     if not api_key:
-        print("❌ Error: Se requiere una API Key de OpenAI.")
-        print("   Opciones:")
-        print("   1. Usa --api-key <tu-key>")
-        print("   2. Configura la variable de entorno OPENAI_API_KEY o API_KEY")
-        print("   3. Crea un archivo .env en src/ con: API_KEY=tu-key")
+        log.error("❌ Error: Se requiere una API Key de OpenAI.")
+        log.info("   Opciones:")
+        log.info("   1. Usa --api-key <tu-key>")
+        log.info("   2. Configura la variable de entorno OPENAI_API_KEY o API_KEY")
+        log.info("   3. Crea un archivo .env en src/ con: API_KEY=tu-key")
         import sys
         sys.exit(1)
     
     # Crear procesador
-    processor = ExcelRadicationProcessor(api_key, args.model)
+    processor = ExcelRadicationProcessor(
+        api_key,
+        args.model,
+        cache_dir=None if args.no_cache else args.cache_dir
+    )
     
     # Procesar archivos
-    results = processor.process_multiple_excel_files(
-        args.excel_files,
-        args.output_dir
-    )
+    if args.batch:
+        results = processor.process_multiple_excel_files_batch(
+            args.excel_files,
+            args.output_dir
+        )
+    else:
+        results = processor.process_multiple_excel_files(
+            args.excel_files,
+            args.output_dir,
+            max_concurrency=args.max_concurrency,
+            combine_batch_size=args.combine,
+            rpm=args.rpm
+        )
     
     # Guardar estadísticas
-    import json
     stats_file = os.path.join(args.output_dir, "processing_stats.json")
-    with open(stats_file, 'w', encoding='utf-8') as f:
-        json.dump(results, f, indent=2, ensure_ascii=False)
+    _dump_json_file(stats_file, results)
     
-    print(f"\nEstadísticas guardadas en: {stats_file}")
+    log.info(f"Estadísticas guardadas en: {stats_file}")
 
 
 if __name__ == "__main__":
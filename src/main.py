@@ -4,16 +4,61 @@ CLI para procesar archivos Excel con OpenAI
 ===========================================
 """
 
-import argparse
+import asyncio
+import atexit
+import logging
 import os
+from hashlib import blake2b
+from logging.handlers import QueueHandler, QueueListener
+import queue
 import sys
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from openai_excel_helper import OpenAIExcelProcessor, simple_excel_query, extract_structured_data
-from config import get_api_key
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+try:
+    # Serializador C (~3-5x más rápido que json stdlib para listas grandes)
+    import orjson
+except ImportError:
+    orjson = None
 
-def interactive_mode(processor: OpenAIExcelProcessor):
+# Los imports de argparse y del SDK de OpenAI (openai_excel_helper/config)
+# se hacen dentro de cada función que los usa: importar este módulo como
+# librería queda casi instantáneo (sin inicializar el SDK), lo que pesa
+# cuando se lanzan varios subprocesos worker.
+
+# Logger por cola: los workers encolan el mensaje (no bloquean en el lock
+# de stdout) y un QueueListener de fondo hace la escritura real. El
+# formato por defecto ("%(message)s") conserva la salida actual.
+_log_q: "queue.Queue" = queue.Queue(-1)
+_log_listener = QueueListener(_log_q, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+log = logging.getLogger("codes")
+log.addHandler(QueueHandler(_log_q))
+log.setLevel(logging.INFO)
+log.propagate = False
+
+# Rutas base calculadas una sola vez al importar: src/ y la carpeta
+# resources/ (la de src/ si existe, si no la del raíz del repo)
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_ROOT_DIR = os.path.dirname(_SRC_DIR)
+if os.path.exists(os.path.join(_SRC_DIR, 'resources')):
+    _RESOURCES_DIR = os.path.join(_SRC_DIR, 'resources')
+else:
+    _RESOURCES_DIR = os.path.join(_ROOT_DIR, 'resources')
+
+
+def _default_result_path() -> str:
+    """Ruta por defecto de result.json, creando resources/ si hace falta."""
+    os.makedirs(_RESOURCES_DIR, exist_ok=True)
+    return os.path.join(_RESOURCES_DIR, 'result.json')
+
+
+def interactive_mode(processor: "OpenAIExcelProcessor"):
     """
     Modo interactivo para hacer múltiples consultas sobre el archivo.
     """
@@ -75,6 +120,8 @@ def single_query_mode(excel_path: str, api_key: str, query: str, model: str):
     """
     Modo de consulta única.
     """
+    from openai_excel_helper import simple_excel_query
+
     print(f"\nConsultando: {query}")
     print("-" * 80)
     
@@ -91,6 +138,8 @@ def structured_extraction_mode(excel_path: str, api_key: str, model: str):
     """
     Modo de extracción estructurada - ejemplo con schema predefinido.
     """
+    from openai_excel_helper import extract_structured_data
+
     print("\nExtrayendo datos estructurados del archivo...")
     print("-" * 80)
     
@@ -130,53 +179,389 @@ Analiza el archivo Excel y extrae la siguiente información:
     result = extract_structured_data(api_key, excel_path, schema, instructions, model)
     
     if result["success"]:
-        import json
         print("\nDatos extraídos:")
         print(json.dumps(result["data"], indent=2, ensure_ascii=False))
     else:
         print(f"\n❌ Error: {result['error']}")
 
 
-def process_single_code(api_key: str, excel_path: str, model: str, line: str, idx: int, total_lines: int):
+def _json_loads(raw):
+    """Parsea JSON con orjson si está disponible; si no, json stdlib."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _json_dump_file(path: str, data, indent: bool = True):
+    """Serializa a un archivo en una sola escritura (orjson o stdlib)."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, option=option))
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2 if indent else None, ensure_ascii=False)
+
+
+class TokenBucket:
+    """
+    Limitador de tokens-por-minuto compartido entre los hilos workers.
+
+    En vez de aproximar el límite de 1M TPM con "8 peticiones
+    simultáneas" (que desperdicia cuota con respuestas chicas y la
+    revienta con respuestas grandes), cada worker adquiere los tokens
+    estimados de su petición antes de llamar a la API y reconcilia con
+    el consumo real al terminar. Los tokens se reponen de forma continua
+    a capacity/60 por segundo.
+    """
+
+    DEFAULT_ESTIMATE = 90_000  # ~tokens por petición hasta tener datos reales
+
+    def __init__(self, capacity: int = 1_000_000):
+        self.capacity = capacity
+        self.refill_per_sec = capacity / 60.0
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        # Promedio móvil del consumo real para estimar mejor
+        self._avg_tokens = float(self.DEFAULT_ESTIMATE)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.capacity),
+            self._tokens + (now - self._updated) * self.refill_per_sec
+        )
+        self._updated = now
+
+    def estimate(self) -> int:
+        """Estimación de tokens para la próxima petición."""
+        with self._lock:
+            return int(self._avg_tokens)
+
+    def _try_acquire(self, tokens: int) -> float:
+        """Intenta descontar `tokens`; devuelve 0 si pudo, o los segundos
+        de espera hasta que el refill los cubra."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            deficit = tokens - self._tokens
+        return deficit / self.refill_per_sec
+
+    def acquire(self, tokens: int):
+        """Bloquea hasta que haya `tokens` disponibles en el bucket."""
+        while True:
+            # Dormir fuera del lock para no frenar a los demás workers
+            delay = self._try_acquire(tokens)
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens: int):
+        """Como acquire(), pero cediendo el event loop en vez de bloquear
+        el hilo (para la ruta asyncio)."""
+        while True:
+            delay = self._try_acquire(tokens)
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def reconcile(self, actual: int, estimated: int):
+        """Ajusta el bucket con el consumo real y actualiza el promedio."""
+        with self._lock:
+            # Si se consumió más de lo estimado, devolver la diferencia al
+            # débito; si menos, acreditarla
+            self._tokens = min(float(self.capacity), self._tokens - (actual - estimated))
+            if actual > 0:
+                self._avg_tokens = 0.8 * self._avg_tokens + 0.2 * actual
+
+    def penalize(self):
+        """Tras un 429, vacía el bucket y fuerza ~1s extra de espera global."""
+        with self._lock:
+            self._tokens = min(self._tokens, -self.refill_per_sec)
+
+
+class QueryCache:
+    """
+    Memoiza las respuestas por (original_code, product_name) normalizados:
+    los archivos de entrada reales repiten productos, y cada duplicado
+    costaba una llamada completa (~90k tokens). Se persiste en
+    query_cache.json con el mismo esquema de flush con debounce del
+    ResultStore, así las corridas siguientes también aprovechan el caché.
+    """
+
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, path: str):
+        self._path = path
+        self._data = {}
+        self._dirty = False
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self._data = _json_loads(f.read())
+                print(f"♻️  Caché de consultas: {len(self._data)} entradas previas")
+            except Exception as e:
+                print(f"⚠️  No se pudo cargar el caché de consultas: {e}")
+
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _key(original_code: str, product_name: str) -> str:
+        return f"{original_code.casefold()}\t{product_name.casefold()}"
+
+    def get(self, original_code: str, product_name: str):
+        with self._lock:
+            return self._data.get(self._key(original_code, product_name))
+
+    def put(self, original_code: str, product_name: str, response: str):
+        with self._lock:
+            self._data[self._key(original_code, product_name)] = response
+            self._dirty = True
+        if time.monotonic() - self._last_flush > self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = dict(self._data)
+            self._dirty = False
+            self._last_flush = time.monotonic()
+
+        try:
+            tmp_path = self._path + '.tmp'
+            _json_dump_file(tmp_path, snapshot, indent=False)
+            os.replace(tmp_path, self._path)
+        except Exception as e:
+            print(f"⚠️  Error al guardar el caché de consultas: {e}")
+
+
+class ResultStore:
+    """
+    Acumula los resultados en memoria y los vuelca a result.json con
+    debounce: como máximo una escritura cada FLUSH_INTERVAL segundos en
+    vez de reescribir el array completo por cada future completado (eso
+    era O(N²) en bytes escritos). El flush final y el hook de atexit
+    garantizan que nada quede solo en memoria.
+    """
+
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, output_path: str, results: list = None):
+        self._output_path = output_path
+        self._results = list(results) if results else []
+        self._dirty = False
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+        # Bitácora append-only: una línea por resultado, O(1) por escritura.
+        # result.json se materializa con debounce / al final a partir de la
+        # lista en memoria; ante un crash, el .jsonl tiene todo.
+        self._jsonl_path = os.path.splitext(output_path)[0] + '.jsonl'
+        self._jsonl = open(self._jsonl_path, 'a', buffering=1 << 20, encoding='utf-8')
+        # Índice binario de líneas resueltas: 8 bytes (blake2b) por entrada
+        # exitosa, para reconstruir processed_keys en el arranque sin
+        # re-hashear todo el historial
+        self._idx_path = os.path.splitext(output_path)[0] + '.idx'
+        self._idx = open(self._idx_path, 'ab')
+        atexit.register(self.close)
+
+    @property
+    def results(self) -> list:
+        """Copia instantánea de los resultados acumulados."""
+        with self._lock:
+            return list(self._results)
+
+    def append(self, entry: dict):
+        """Agrega un resultado y dispara un flush si ya toca."""
+        with self._lock:
+            self._results.append(entry)
+            self._dirty = True
+            self._log(entry)
+        self._maybe_flush()
+
+    def replace(self, idx: int, entry: dict):
+        """Actualiza el resultado en una posición (para reintentos)."""
+        with self._lock:
+            self._results[idx] = entry
+            self._dirty = True
+            # En la bitácora append-only la última línea por código gana
+            self._log(entry)
+        self._maybe_flush()
+
+    def _log(self, entry: dict):
+        """Escribe una línea en el .jsonl (llamar con el lock tomado)."""
+        try:
+            if orjson is not None:
+                self._jsonl.write(orjson.dumps(entry).decode('utf-8') + '\n')
+            else:
+                self._jsonl.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        except Exception as e:
+            print(f"⚠️  Error escribiendo en {self._jsonl_path}: {e}")
+
+        if entry.get('error') is None:
+            try:
+                self._idx.write(_line_key(entry.get('original_line', '').strip()))
+            except Exception:
+                pass  # el índice es solo una aceleración; se reconstruye solo
+
+    def close(self):
+        """Flush final (con fsync) y cierre de la bitácora."""
+        self.flush(fsync=True)
+        try:
+            self._jsonl.close()
+        except Exception:
+            pass
+        try:
+            self._idx.close()
+        except Exception:
+            pass
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush > self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self, fsync: bool = False):
+        """Escribe los resultados a disco de forma atómica (tmp + replace).
+
+        fsync solo en el flush de cierre: en los flushes con debounce el
+        os.replace ya garantiza ver o el archivo viejo o el nuevo, y un
+        fsync por flush puede costar milisegundos en HDD/NFS.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = list(self._results)
+            self._dirty = False
+            self._last_flush = time.monotonic()
+
+        try:
+            out_dir = os.path.dirname(os.path.abspath(self._output_path)) or '.'
+            fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.json.tmp')
+            if orjson is not None:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(orjson.dumps(
+                        snapshot,
+                        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+                    ))
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+            else:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f, indent=2, ensure_ascii=False)
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+            os.replace(tmp_path, self._output_path)
+        except Exception as e:
+            print(f"⚠️  Error al guardar resultados: {e}")
+
+
+def process_single_code(api_key: str, excel_path: str, model: str, line: str, idx: int, total_lines: int,
+                        bucket: "TokenBucket" = None, processor=None,
+                        cache: "QueryCache" = None):
     """
     Procesa una sola línea del archivo de códigos.
-    Función auxiliar para procesamiento paralelo.
+    Función auxiliar para procesamiento paralelo. Si recibe un
+    TokenBucket, adquiere los tokens estimados antes de llamar a la API
+    y reintenta hasta 3 veces ante un 429. Si recibe un
+    OpenAIExcelProcessor compartido, reusa su contenido de Excel ya
+    serializado en vez de re-leer el archivo por cada código.
     """
+    import openai
+    from openai_excel_helper import simple_excel_query
+
     line = line.strip()
     if not line:
         return None
     
-    # Separar código original y nombre del producto (puede ser espacio o tab)
-    if '\t' in line:
-        parts = line.split('\t', 1)
-    else:
-        parts = line.split(' ', 1)
-    
-    if len(parts) < 2:
-        print(f"[{idx}/{total_lines}] ⚠️  Línea inválida: {line}")
+    # Separar código original y nombre del producto (puede ser espacio o tab).
+    # partition escanea una sola vez y siempre devuelve 3 partes.
+    head, sep, tail = line.partition('\t')
+    if not sep:
+        head, sep, tail = line.partition(' ')
+
+    if not sep:
+        log.info(f"[{idx}/{total_lines}] ⚠️  Línea inválida: {line}")
         return {
             "original_line": line,
-            "original_code": parts[0] if parts else "",
+            "original_code": head,
             "product_name": "",
             "found_code": None,
             "error": "Formato inválido"
         }
-    
-    original_code = parts[0].strip()
-    product_name = parts[1].strip()
-    
-    print(f"[{idx}/{total_lines}] 🔄 Procesando: {original_code} - {product_name[:50]}...")
+
+    original_code = head.strip()
+    product_name = tail.strip()
+
+    # Duplicado exacto ya resuelto: responder desde el caché sin llamar a la API
+    if cache is not None:
+        cached_response = cache.get(original_code, product_name)
+        if cached_response is not None:
+            log.info(f"[{idx}/{total_lines}] ♻️  {original_code}: resultado desde caché")
+            return {
+                "original_line": line,
+                "original_code": original_code,
+                "product_name": product_name,
+                "found_code": cached_response,
+                "tokens_used": 0,
+                "error": None
+            }
+
+    if log.isEnabledFor(logging.INFO):
+        log.info(f"[{idx}/{total_lines}] 🔄 Procesando: {original_code} - {product_name[:50]}...")
     
     # Construir el query
     query = f"Código original: {original_code}\nBusca el código MD para: {product_name}"
     
     try:
-        result = simple_excel_query(api_key, excel_path, query, model=model)
-        
+        result = None
+        for attempt in range(3):
+            estimated = bucket.estimate() if bucket else 0
+            if bucket:
+                bucket.acquire(estimated)
+
+            try:
+                if processor is not None:
+                    # Ruta compartida: el contenido del Excel ya está en
+                    # memoria; la llamada no toca el historial (thread-safe)
+                    result = processor.query_with_excel_content(excel_path, query)
+                else:
+                    result = simple_excel_query(api_key, excel_path, query, model=model)
+            except openai.RateLimitError:
+                if bucket:
+                    # Vaciar el bucket frena a todos los workers un momento
+                    bucket.penalize()
+                log.info(f"[{idx}/{total_lines}] ⏳ 429 recibido, reintento {attempt + 1}/3...")
+                continue
+
+            if bucket:
+                bucket.reconcile(result.get("total_tokens", 0), estimated)
+            break
+
+        if result is None:
+            return {
+                "original_line": line,
+                "original_code": original_code,
+                "product_name": product_name,
+                "found_code": None,
+                "error": "Rate limit (429) tras 3 intentos"
+            }
+
         if result["success"]:
             response = result["response"]
-            print(f"[{idx}/{total_lines}] ✓ {original_code}: {response[:80]}...")
-            
+            if log.isEnabledFor(logging.INFO):
+                log.info(f"[{idx}/{total_lines}] ✓ {original_code}: {response[:80]}...")
+
+            if cache is not None:
+                cache.put(original_code, product_name, response)
+
             return {
                 "original_line": line,
                 "original_code": original_code,
@@ -186,7 +571,7 @@ def process_single_code(api_key: str, excel_path: str, model: str, line: str, id
                 "error": None
             }
         else:
-            print(f"[{idx}/{total_lines}] ✗ {original_code}: {result['error']}")
+            log.info(f"[{idx}/{total_lines}] ✗ {original_code}: {result['error']}")
             return {
                 "original_line": line,
                 "original_code": original_code,
@@ -196,7 +581,124 @@ def process_single_code(api_key: str, excel_path: str, model: str, line: str, id
             }
     
     except Exception as e:
-        print(f"[{idx}/{total_lines}] ✗ {original_code}: Excepción: {str(e)}")
+        log.info(f"[{idx}/{total_lines}] ✗ {original_code}: Excepción: {str(e)}")
+        return {
+            "original_line": line,
+            "original_code": original_code,
+            "product_name": product_name,
+            "found_code": None,
+            "error": str(e)
+        }
+
+
+async def process_single_code_async(excel_path: str, model: str, line: str, idx: int, total_lines: int,
+                                    bucket: "TokenBucket", processor, cache: "QueryCache",
+                                    client):
+    """
+    Variante asíncrona de process_single_code para la ruta asyncio:
+    misma lógica de parseo, caché y reintentos ante 429, pero esperando
+    con asyncio.sleep (cede el event loop) y despachando la llamada por
+    el cliente AsyncOpenAI compartido.
+    """
+    import openai
+
+    line = line.strip()
+    if not line:
+        return None
+
+    head, sep, tail = line.partition('\t')
+    if not sep:
+        head, sep, tail = line.partition(' ')
+
+    if not sep:
+        log.info(f"[{idx}/{total_lines}] ⚠️  Línea inválida: {line}")
+        return {
+            "original_line": line,
+            "original_code": head,
+            "product_name": "",
+            "found_code": None,
+            "error": "Formato inválido"
+        }
+
+    original_code = head.strip()
+    product_name = tail.strip()
+
+    if cache is not None:
+        cached_response = cache.get(original_code, product_name)
+        if cached_response is not None:
+            log.info(f"[{idx}/{total_lines}] ♻️  {original_code}: resultado desde caché")
+            return {
+                "original_line": line,
+                "original_code": original_code,
+                "product_name": product_name,
+                "found_code": cached_response,
+                "tokens_used": 0,
+                "error": None
+            }
+
+    if log.isEnabledFor(logging.INFO):
+        log.info(f"[{idx}/{total_lines}] 🔄 Procesando: {original_code} - {product_name[:50]}...")
+
+    query = f"Código original: {original_code}\nBusca el código MD para: {product_name}"
+
+    try:
+        result = None
+        for attempt in range(3):
+            estimated = bucket.estimate() if bucket else 0
+            if bucket:
+                await bucket.acquire_async(estimated)
+
+            try:
+                result = await processor.query_with_excel_content_async(
+                    excel_path, query, client=client
+                )
+            except openai.RateLimitError:
+                if bucket:
+                    bucket.penalize()
+                log.info(f"[{idx}/{total_lines}] ⏳ 429 recibido, reintento {attempt + 1}/3...")
+                continue
+
+            if bucket:
+                bucket.reconcile(result.get("total_tokens", 0), estimated)
+            break
+
+        if result is None:
+            return {
+                "original_line": line,
+                "original_code": original_code,
+                "product_name": product_name,
+                "found_code": None,
+                "error": "Rate limit (429) tras 3 intentos"
+            }
+
+        if result["success"]:
+            response = result["response"]
+            if log.isEnabledFor(logging.INFO):
+                log.info(f"[{idx}/{total_lines}] ✓ {original_code}: {response[:80]}...")
+
+            if cache is not None:
+                cache.put(original_code, product_name, response)
+
+            return {
+                "original_line": line,
+                "original_code": original_code,
+                "product_name": product_name,
+                "found_code": response,
+                "tokens_used": result.get("total_tokens", 0),
+                "error": None
+            }
+        else:
+            log.info(f"[{idx}/{total_lines}] ✗ {original_code}: {result['error']}")
+            return {
+                "original_line": line,
+                "original_code": original_code,
+                "product_name": product_name,
+                "found_code": None,
+                "error": result['error']
+            }
+
+    except Exception as e:
+        log.info(f"[{idx}/{total_lines}] ✗ {original_code}: Excepción: {str(e)}")
         return {
             "original_line": line,
             "original_code": original_code,
@@ -206,7 +708,155 @@ def process_single_code(api_key: str, excel_path: str, model: str, line: str, id
         }
 
 
-def process_codes_to_solve(excel_path: str, api_key: str, txt_path: str, model: str, output_path: str = None, max_workers: int = 8):
+def _line_key(line: str) -> bytes:
+    """
+    Digest de 8 bytes para membresía de líneas ya procesadas: con miles
+    de entradas previas, guardar digests en vez de las líneas completas
+    reduce la memoria del set ~10-40x y abarata cada lookup (colisiones
+    a 64 bits son despreciables a esta escala).
+    """
+    return blake2b(line.encode('utf-8'), digest_size=8).digest()
+
+
+def _load_existing_results(output_path: str) -> list:
+    """
+    Carga los resultados previos. Prefiere la bitácora .jsonl (streaming,
+    la última línea de cada código gana) y cae al result.json completo
+    como ruta de migración de corridas anteriores.
+    """
+    jsonl_path = os.path.splitext(output_path)[0] + '.jsonl'
+    by_line = {}
+
+    # Base: el result.json consolidado (corridas previas a la bitácora,
+    # o lo materializado por el último flush/compactación)
+    if os.path.exists(output_path):
+        try:
+            with open(output_path, 'rb') as f:
+                for entry in _json_loads(f.read()):
+                    by_line[entry.get('original_line', '')] = entry
+        except Exception as e:
+            print(f"⚠️  No se pudieron cargar resultados previos: {e}")
+
+    # Encima, la bitácora: por código, la última línea gana
+    if os.path.exists(jsonl_path):
+        try:
+            with open(jsonl_path, 'r', encoding='utf-8') as f:
+                for raw in f:
+                    raw = raw.strip()
+                    if not raw:
+                        continue
+                    try:
+                        entry = _json_loads(raw)
+                    except ValueError:
+                        continue  # línea truncada por un crash
+                    by_line[entry.get('original_line', raw)] = entry
+        except Exception as e:
+            print(f"⚠️  No se pudo leer {jsonl_path}: {e}")
+
+    return list(by_line.values())
+
+
+def _load_processed_keys(output_path: str, existing_results: list) -> frozenset:
+    """
+    Digests (8 bytes) de las líneas ya resueltas. Lee el índice binario
+    .idx si existe (una pasada, sin parsear ni re-hashear nada); si no,
+    lo reconstruye desde los resultados previos y lo materializa para el
+    próximo arranque.
+    """
+    idx_path = os.path.splitext(output_path)[0] + '.idx'
+
+    if os.path.exists(idx_path):
+        try:
+            with open(idx_path, 'rb') as f:
+                data = f.read()
+            if len(data) % 8 == 0:
+                return frozenset(data[i:i + 8] for i in range(0, len(data), 8))
+        except OSError:
+            pass  # índice ilegible: reconstruir desde los resultados
+
+    keys = {
+        _line_key(r.get('original_line', '').strip())
+        for r in existing_results
+        if r.get('error') is None
+    }
+    # Migración: dejar el índice escrito para que el próximo arranque
+    # no tenga que re-hashear el historial
+    try:
+        with open(idx_path, 'wb') as f:
+            f.write(b''.join(keys))
+    except OSError:
+        pass
+    return frozenset(keys)
+
+
+def compact_results(output_path: str):
+    """
+    Materializa el result.json final a partir de la bitácora .jsonl con
+    una sola escritura bonita (para correr después de un crash o cuando
+    solo interesa el archivo consolidado).
+    """
+    results = _load_existing_results(output_path)
+
+    if not results:
+        print("❌ No hay resultados para compactar.")
+        return
+
+    tmp_path = output_path + '.tmp'
+    _json_dump_file(tmp_path, results)
+    os.replace(tmp_path, output_path)
+
+    print(f"💾 {len(results)} resultados compactados en: {output_path}")
+
+
+async def _process_codes_async(lines, excel_path, api_key, model, total_lines,
+                               store, bucket, processor, query_cache, max_workers):
+    """
+    Despacha las consultas con asyncio: un semáforo limita las peticiones
+    en vuelo y un único cliente AsyncOpenAI (con pool de conexiones a
+    medida) atiende todas. Cada corrutina en vuelo cuesta unos KB frente
+    al ~1MB de stack de un hilo, así que subir max_workers es barato.
+    Devuelve la cantidad de resultados procesados.
+    """
+    import httpx
+    import openai
+
+    sem = asyncio.Semaphore(max_workers)
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_workers * 2)
+    )
+    client = openai.AsyncOpenAI(api_key=api_key, http_client=http_client)
+    processed_count = 0
+
+    async def _one(idx, line):
+        async with sem:
+            return await process_single_code_async(
+                excel_path, model, line, idx, total_lines,
+                bucket, processor, query_cache, client
+            )
+
+    tasks = [asyncio.ensure_future(_one(idx, line)) for idx, line in lines]
+    try:
+        # as_completed en vez de gather: cada resultado se persiste apenas
+        # termina, igual que el _drain de la ruta con hilos
+        for future in asyncio.as_completed(tasks):
+            try:
+                result_entry = await future
+            except Exception as e:
+                print(f"⚠️  Error procesando tarea: {e}")
+                continue
+            if result_entry:
+                processed_count += 1
+                store.append(result_entry)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await client.close()
+
+    return processed_count
+
+
+def process_codes_to_solve(excel_path: str, api_key: str, txt_path: str, model: str, output_path: str = None, max_workers: int = 32,
+                           use_threads: bool = False):
     """
     Procesa un archivo de texto con códigos a resolver usando procesamiento paralelo en lotes.
     Lee el archivo donde cada línea tiene: CODIGO_ORIGINAL NOMBRE_PRODUCTO
@@ -214,10 +864,11 @@ def process_codes_to_solve(excel_path: str, api_key: str, txt_path: str, model:
     Los resultados se van guardando de forma acumulativa en result.json.
     
     Args:
-        max_workers: Número de peticiones paralelas por lote (por defecto 8)
-                    Límite TPM: 1,000,000 tokens/min
-                    ~90,000 tokens por petición
-                    8 peticiones simultáneas = ~720,000 tokens (margen de seguridad)
+        max_workers: Número de peticiones paralelas (por defecto 32).
+                    El límite de 1,000,000 TPM lo gobierna el TokenBucket
+                    compartido, no la cantidad de workers.
+        use_threads: Usar la ruta clásica con ThreadPoolExecutor en vez
+                    de asyncio (--legacy-threads).
     """
     print(txt_path)
     if not os.path.exists(txt_path):
@@ -226,54 +877,38 @@ def process_codes_to_solve(excel_path: str, api_key: str, txt_path: str, model:
     
     # Definir la ruta del archivo de resultados
     if output_path is None:
-        # Buscar la carpeta resources
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        parent_dir = os.path.dirname(current_dir)
-        
-        if os.path.exists(os.path.join(current_dir, 'resources')):
-            resources_dir = os.path.join(current_dir, 'resources')
-        elif os.path.exists(os.path.join(parent_dir, 'resources')):
-            resources_dir = os.path.join(parent_dir, 'resources')
-        else:
-            resources_dir = os.path.join(parent_dir, 'resources')
-            os.makedirs(resources_dir, exist_ok=True)
-        
-        output_path = os.path.join(resources_dir, 'result.json')
-    
-    # Cargar resultados existentes si el archivo existe
-    existing_results = []
-    processed_lines = set()  # Para trackear líneas ya procesadas exitosamente
+        output_path = _default_result_path()
     
-    if os.path.exists(output_path):
-        try:
-            with open(output_path, 'r', encoding='utf-8') as f:
-                existing_results = json.load(f)
-            print(f"📄 Cargados {len(existing_results)} resultados previos de {output_path}")
-            
-            # Crear un set de líneas ya procesadas exitosamente (sin error)
-            for result in existing_results:
-                if result.get('error') is None:
-                    processed_lines.add(result.get('original_line', '').strip())
-            
-            print(f"✅ {len(processed_lines)} códigos ya procesados exitosamente (se omitirán)")
-        except Exception as e:
-            print(f"⚠️  No se pudieron cargar resultados previos: {e}")
+    # Cargar resultados existentes: primero la bitácora .jsonl (streaming,
+    # línea por línea); si no existe, el result.json clásico como migración
+    existing_results = _load_existing_results(output_path)
+    processed_keys = _load_processed_keys(output_path, existing_results)
+
+    if existing_results:
+        print(f"📄 Cargados {len(existing_results)} resultados previos")
+        print(f"✅ {len(processed_keys)} códigos ya procesados exitosamente (se omitirán)")
     
     print(f"\nProcesando códigos desde: {txt_path}")
     print(f"Usando Excel: {excel_path}")
     print(f"Guardando en: {output_path}")
-    print(f"⚡ Procesamiento en lotes de {max_workers} peticiones simultáneas")
+    print(f"⚡ Procesamiento continuo con {max_workers} peticiones simultáneas")
     print(f"💡 Límite TPM: 1,000,000 tokens (~{max_workers} peticiones × ~90k tokens)")
     print("-" * 80)
     
-    # Leer el archivo de códigos y filtrar líneas vacías y ya procesadas
+    # Leer el archivo de códigos en una sola pasada streaming: sin
+    # readlines() ni listas intermedias, filtrando vacías y ya procesadas
+    lines = []
+    skipped_count = 0
     with open(txt_path, 'r', encoding='utf-8') as f:
-        all_lines = [(idx, line) for idx, line in enumerate(f.readlines(), 1) if line.strip()]
-    
-    # Filtrar las líneas ya procesadas exitosamente
-    lines = [(idx, line) for idx, line in all_lines if line.strip() not in processed_lines]
-    
-    skipped_count = len(all_lines) - len(lines)
+        for idx, line in enumerate(f, 1):
+            stripped = line.strip()
+            if not stripped:
+                continue
+            if _line_key(stripped) in processed_keys:
+                skipped_count += 1
+                continue
+            lines.append((idx, line))
+
     if skipped_count > 0:
         print(f"⏭️  Omitiendo {skipped_count} códigos ya procesados exitosamente")
     
@@ -281,49 +916,75 @@ def process_codes_to_solve(excel_path: str, api_key: str, txt_path: str, model:
         print("✅ No hay códigos nuevos para procesar. Todos ya fueron procesados exitosamente.")
         return
     
-    results = existing_results.copy()
+    store = ResultStore(output_path, existing_results)
     total_lines = len(lines)
     processed_count = 0
-    
-    # Procesar en lotes
-    for batch_start in range(0, len(lines), max_workers):
-        batch_end = min(batch_start + max_workers, len(lines))
-        batch = lines[batch_start:batch_end]
-        batch_num = (batch_start // max_workers) + 1
-        total_batches = (len(lines) + max_workers - 1) // max_workers
-        
-        print(f"\n{'='*80}")
-        print(f"📦 LOTE {batch_num}/{total_batches} - Procesando {len(batch)} códigos...")
-        print(f"{'='*80}")
-        
-        # Procesar el lote actual en paralelo
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Crear tareas para este lote
-            futures = {
-                executor.submit(process_single_code, api_key, excel_path, model, line, idx, total_lines): idx
-                for idx, line in batch
-            }
-            
-            # Esperar a que todas las tareas del lote se completen
-            for future in as_completed(futures):
-                try:
-                    result_entry = future.result()
-                    if result_entry:
-                        results.append(result_entry)
-                        processed_count += 1
-                        
-                        # Guardar después de cada resultado completado
-                        try:
-                            with open(output_path, 'w', encoding='utf-8') as f:
-                                json.dump(results, f, indent=2, ensure_ascii=False)
-                        except Exception as e:
-                            print(f"⚠️  Error al guardar resultados: {e}")
-                
-                except Exception as e:
-                    print(f"⚠️  Error procesando future: {e}")
-        
-        print(f"✅ Lote {batch_num}/{total_batches} completado. Total procesados: {processed_count}/{total_lines}")
-    
+
+    def _drain(done_futures):
+        nonlocal processed_count
+        for future in done_futures:
+            try:
+                result_entry = future.result()
+                if result_entry:
+                    processed_count += 1
+                    # Guardado con debounce: el store decide cuándo escribir
+                    store.append(result_entry)
+            except Exception as e:
+                print(f"⚠️  Error procesando future: {e}")
+
+    # Límite real de TPM compartido entre workers (reemplaza la heurística
+    # de "N workers ≈ N x 90k tokens")
+    bucket = TokenBucket()
+
+    # Un solo procesador compartido: el Excel se lee y serializa UNA vez
+    # y las N consultas reusan ese contenido
+    from openai_excel_helper import OpenAIExcelProcessor
+
+    processor = OpenAIExcelProcessor(api_key, model)
+    processor._excel_csv_info(excel_path)  # pre-carga antes de despachar
+
+    # Caché de respuestas por (código, producto) normalizados
+    query_cache = QueryCache(
+        os.path.join(os.path.dirname(os.path.abspath(output_path)), 'query_cache.json')
+    )
+
+    try:
+        if use_threads:
+            # Ruta clásica con hilos (--legacy-threads): un solo executor
+            # para toda la corrida, con tope de in-flight (2x workers)
+            # como backpressure para no acumular futures.
+            max_inflight = max_workers * 2
+            inflight = set()
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            try:
+                for idx, line in lines:
+                    while len(inflight) >= max_inflight:
+                        done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                        _drain(done)
+
+                    inflight.add(executor.submit(
+                        process_single_code, api_key, excel_path, model, line, idx, total_lines,
+                        bucket, processor, query_cache
+                    ))
+
+                while inflight:
+                    done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                    _drain(done)
+            finally:
+                executor.shutdown(wait=True)
+        else:
+            # Ruta por defecto: asyncio con un cliente AsyncOpenAI
+            # compartido; el semáforo cumple el rol del pool de hilos
+            processed_count = asyncio.run(_process_codes_async(
+                lines, excel_path, api_key, model, total_lines,
+                store, bucket, processor, query_cache, max_workers
+            ))
+    finally:
+        store.close()
+        query_cache.flush()
+
+    results = store.results
+
     # Resumen
     print("\n" + "="*80)
     print("RESUMEN DE PROCESAMIENTO")
@@ -335,7 +996,208 @@ def process_codes_to_solve(excel_path: str, api_key: str, txt_path: str, model:
     print(f"\n💾 Resultados guardados en: {output_path}")
 
 
-def retry_failed_codes(excel_path: str, api_key: str, result_json_path: str, model: str, max_workers: int = 8):
+def process_codes_batch(excel_path: str, api_key: str, txt_path: str, model: str, output_path: str = None):
+    """
+    Variante offline de process_codes_to_solve usando la Batch API de
+    OpenAI (--batch): arma un JSONL con una petición por código, lo sube,
+    crea el batch y sondea hasta que termine. Sin malabares de TPM ni
+    reintentos por 429, y el costo por token es ~50% del modo online; a
+    cambio, los resultados pueden tardar hasta 24h.
+    """
+    import openai
+    from openai_excel_helper import OpenAIExcelProcessor, _excel_response_format
+
+    print(txt_path)
+    if not os.path.exists(txt_path):
+        print(f"❌ Error: El archivo '{txt_path}' no existe.")
+        return
+
+    if output_path is None:
+        output_path = _default_result_path()
+
+    existing_results = _load_existing_results(output_path)
+    processed_keys = _load_processed_keys(output_path, existing_results)
+    if existing_results:
+        print(f"📄 Cargados {len(existing_results)} resultados previos")
+
+    # El mismo procesador compartido del modo online: el Excel se
+    # serializa una sola vez y cada petición del batch embebe ese CSV
+    processor = OpenAIExcelProcessor(api_key, model)
+    query_cache = QueryCache(
+        os.path.join(os.path.dirname(os.path.abspath(output_path)), 'query_cache.json')
+    )
+
+    store = ResultStore(output_path, existing_results)
+    # custom_id (digest de la línea) -> (línea, código, producto);
+    # las líneas idénticas colapsan en una sola petición
+    pending = {}
+    skipped_count = 0
+    cached_count = 0
+
+    try:
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                stripped = line.strip()
+                if not stripped:
+                    continue
+                if _line_key(stripped) in processed_keys:
+                    skipped_count += 1
+                    continue
+
+                head, sep, tail = stripped.partition('\t')
+                if not sep:
+                    head, sep, tail = stripped.partition(' ')
+                if not sep:
+                    store.append({
+                        "original_line": stripped,
+                        "original_code": head,
+                        "product_name": "",
+                        "found_code": None,
+                        "error": "Formato inválido"
+                    })
+                    continue
+
+                original_code = head.strip()
+                product_name = tail.strip()
+
+                # Duplicados ya resueltos en el caché: ni siquiera van al batch
+                cached_response = query_cache.get(original_code, product_name)
+                if cached_response is not None:
+                    cached_count += 1
+                    store.append({
+                        "original_line": stripped,
+                        "original_code": original_code,
+                        "product_name": product_name,
+                        "found_code": cached_response,
+                        "tokens_used": 0,
+                        "error": None
+                    })
+                    continue
+
+                pending[_line_key(stripped).hex()] = (stripped, original_code, product_name)
+
+        if skipped_count > 0:
+            print(f"⏭️  Omitiendo {skipped_count} códigos ya procesados exitosamente")
+        if cached_count > 0:
+            print(f"♻️  {cached_count} códigos resueltos desde el caché")
+
+        if not pending:
+            print("✅ No hay códigos nuevos para enviar al batch.")
+            return
+
+        print(f"\n📦 Preparando batch con {len(pending)} peticiones...")
+
+        # Una línea JSONL por petición, con el mismo body que usaría el
+        # modo online contra /v1/chat/completions
+        request_lines = []
+        for custom_id, (stripped, original_code, product_name) in pending.items():
+            query = f"Código original: {original_code}\nBusca el código MD para: {product_name}"
+            full_prompt = processor._build_excel_prompt(excel_path, query,
+                                                        prefilter=True)
+            body = processor._completion_kwargs(
+                full_prompt, 1, model, None,
+                _excel_response_format(excel_path)
+            )
+            request = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }
+            if orjson is not None:
+                request_lines.append(orjson.dumps(request))
+            else:
+                request_lines.append(json.dumps(request, ensure_ascii=False).encode('utf-8'))
+
+        client = openai.OpenAI(api_key=api_key)
+
+        # El SDK espera un archivo: volcar el JSONL a un temporal y
+        # borrarlo apenas quede subido (mismo patrón que submit_batch
+        # del procesador de radicaciones)
+        fd, jsonl_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(output_path)), suffix='.batch.jsonl'
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b'\n'.join(request_lines) + b'\n')
+            with open(jsonl_path, 'rb') as f:
+                input_file = client.files.create(file=f, purpose="batch")
+        finally:
+            os.remove(jsonl_path)
+
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        print(f"🚀 Batch creado: {batch.id}")
+
+        # Sondeo con backoff: empieza en 10s y se estira hasta 5 min
+        poll_delay = 10.0
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            print(f"⏳ Estado del batch: {batch.status} (próximo chequeo en {int(poll_delay)}s)")
+            time.sleep(poll_delay)
+            poll_delay = min(poll_delay * 2, 300.0)
+            batch = client.batches.retrieve(batch.id)
+
+        if batch.status != "completed":
+            print(f"❌ El batch terminó en estado '{batch.status}'")
+            return
+
+        # Parsear el archivo de salida en streaming, línea por línea
+        processed_count = 0
+        output_content = client.files.content(batch.output_file_id)
+        for raw in output_content.text.splitlines():
+            raw = raw.strip()
+            if not raw:
+                continue
+            obj = _json_loads(raw)
+            meta = pending.get(obj.get("custom_id"))
+            if meta is None:
+                continue
+            stripped, original_code, product_name = meta
+
+            response_body = (obj.get("response") or {}).get("body") or {}
+            error = obj.get("error")
+            if error or not response_body:
+                store.append({
+                    "original_line": stripped,
+                    "original_code": original_code,
+                    "product_name": product_name,
+                    "found_code": None,
+                    "error": str(error) if error else "Respuesta vacía del batch"
+                })
+                continue
+
+            response = response_body["choices"][0]["message"]["content"]
+            tokens = (response_body.get("usage") or {}).get("total_tokens", 0)
+            query_cache.put(original_code, product_name, response)
+            store.append({
+                "original_line": stripped,
+                "original_code": original_code,
+                "product_name": product_name,
+                "found_code": response,
+                "tokens_used": tokens,
+                "error": None
+            })
+            processed_count += 1
+
+        print(f"\n✓ {processed_count} resultados recibidos del batch")
+    finally:
+        store.close()
+        query_cache.flush()
+
+    results = store.results
+    print("\n" + "="*80)
+    print("RESUMEN DE PROCESAMIENTO (BATCH)")
+    print("="*80)
+    print(f"Total de resultados en archivo: {len(results)}")
+    print(f"Exitosas (total): {sum(1 for r in results if r.get('error') is None)}")
+    print(f"Con errores (total): {sum(1 for r in results if r.get('error') is not None)}")
+    print(f"\n💾 Resultados guardados en: {output_path}")
+
+
+def retry_failed_codes(excel_path: str, api_key: str, result_json_path: str, model: str, max_workers: int = 32):
     """
     Reintenta procesar los códigos que tuvieron error en result.json.
     Actualiza los registros con error y los marca como exitosos si se completan.
@@ -344,13 +1206,19 @@ def retry_failed_codes(excel_path: str, api_key: str, result_json_path: str, mod
         print(f"❌ Error: El archivo '{result_json_path}' no existe.")
         return
     
-    # Cargar resultados existentes
+    # Cargar resultados existentes, incluido el sidecar .jsonl: tras un
+    # crash, result.json puede estar desactualizado y solo la bitácora
+    # sabe qué códigos ya se resolvieron (reintentarlos desperdiciaría
+    # tokens y un fallo pisaría el éxito ya registrado)
     try:
-        with open(result_json_path, 'r', encoding='utf-8') as f:
-            all_results = json.load(f)
+        all_results = _load_existing_results(result_json_path)
     except Exception as e:
         print(f"❌ Error cargando {result_json_path}: {e}")
         return
+
+    if not all_results:
+        print(f"❌ Error: No hay resultados en '{result_json_path}'.")
+        return
     
     # Filtrar solo los que tienen error
     failed_results = [r for r in all_results if r.get('error') is not None]
@@ -361,78 +1229,95 @@ def retry_failed_codes(excel_path: str, api_key: str, result_json_path: str, mod
     
     print(f"\n🔄 Reintentando {len(failed_results)} códigos con error...")
     print(f"Usando Excel: {excel_path}")
-    print(f"⚡ Procesamiento en lotes de {max_workers} peticiones simultáneas")
+    print(f"⚡ Procesamiento continuo con {max_workers} peticiones simultáneas")
     print("-" * 80)
     
     retry_count = 0
     success_count = 0
     
-    # Crear un diccionario para actualizar resultados por índice
-    results_dict = {i: r for i, r in enumerate(all_results)}
+    # Escrituras con debounce sobre el mismo array de resultados;
+    # el store es el dueño canónico de la lista durante los reintentos
+    store = ResultStore(result_json_path, all_results)
     
     # Encontrar los índices de los elementos con error
     failed_indices = [i for i, r in enumerate(all_results) if r.get('error') is not None]
     
-    # Procesar en lotes
-    for batch_start in range(0, len(failed_indices), max_workers):
-        batch_end = min(batch_start + max_workers, len(failed_indices))
-        batch_indices = failed_indices[batch_start:batch_end]
-        batch_num = (batch_start // max_workers) + 1
-        total_batches = (len(failed_indices) + max_workers - 1) // max_workers
-        
-        print(f"\n{'='*80}")
-        print(f"📦 LOTE {batch_num}/{total_batches} - Reintentando {len(batch_indices)} códigos...")
-        print(f"{'='*80}")
-        
-        # Procesar el lote actual en paralelo
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Crear tareas para este lote
-            futures = {}
-            for idx in batch_indices:
-                result = all_results[idx]
-                original_code = result.get('original_code', '')
-                product_name = result.get('product_name', '')
-                line = result.get('original_line', f"{original_code}\t{product_name}")
-                
-                future = executor.submit(
-                    process_single_code, 
-                    api_key, 
-                    excel_path, 
-                    model, 
-                    line, 
-                    idx + 1,  # Mostrar índice base 1
-                    len(all_results)
-                )
-                futures[future] = idx
-            
-            # Esperar a que todas las tareas del lote se completen
-            for future in as_completed(futures):
-                original_idx = futures[future]
-                try:
-                    result_entry = future.result()
-                    if result_entry:
-                        retry_count += 1
-                        
-                        # Si no tiene error, es exitoso
-                        if result_entry.get('error') is None:
-                            success_count += 1
-                        
-                        # Actualizar el resultado en la posición original
-                        results_dict[original_idx] = result_entry
-                        
-                        # Guardar después de cada actualización
-                        try:
-                            updated_results = [results_dict[i] for i in range(len(results_dict))]
-                            with open(result_json_path, 'w', encoding='utf-8') as f:
-                                json.dump(updated_results, f, indent=2, ensure_ascii=False)
-                        except Exception as e:
-                            print(f"⚠️  Error al guardar resultados: {e}")
-                
-                except Exception as e:
-                    print(f"⚠️  Error procesando future: {e}")
-        
-        print(f"✅ Lote {batch_num}/{total_batches} completado.")
-    
+    index_by_future = {}
+
+    def _drain(done_futures):
+        nonlocal retry_count, success_count
+        for future in done_futures:
+            original_idx = index_by_future.pop(future)
+            try:
+                result_entry = future.result()
+                if result_entry:
+                    retry_count += 1
+
+                    # Si no tiene error, es exitoso
+                    if result_entry.get('error') is None:
+                        success_count += 1
+
+                    # Actualizar el resultado en su posición original,
+                    # con guardado debounced (tmp + replace atómico)
+                    store.replace(original_idx, result_entry)
+
+            except Exception as e:
+                print(f"⚠️  Error procesando future: {e}")
+
+    # Un solo executor para todos los reintentos, con tope de in-flight
+    # (2x workers) en vez de lotes con barrera
+    max_inflight = max_workers * 2
+    inflight = set()
+
+    # Límite real de TPM compartido entre workers
+    bucket = TokenBucket()
+
+    # Procesador compartido: una sola lectura/serialización del Excel
+    from openai_excel_helper import OpenAIExcelProcessor
+
+    processor = OpenAIExcelProcessor(api_key, model)
+    processor._excel_csv_info(excel_path)
+
+    # Caché de respuestas por (código, producto) normalizados
+    query_cache = QueryCache(
+        os.path.join(os.path.dirname(os.path.abspath(result_json_path)), 'query_cache.json')
+    )
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for idx in failed_indices:
+            while len(inflight) >= max_inflight:
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                _drain(done)
+
+            result = all_results[idx]
+            original_code = result.get('original_code', '')
+            product_name = result.get('product_name', '')
+            line = result.get('original_line', f"{original_code}\t{product_name}")
+
+            future = executor.submit(
+                process_single_code,
+                api_key,
+                excel_path,
+                model,
+                line,
+                idx + 1,  # Mostrar índice base 1
+                len(all_results),
+                bucket,
+                processor,
+                query_cache
+            )
+            index_by_future[future] = idx
+            inflight.add(future)
+
+        while inflight:
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            _drain(done)
+    finally:
+        executor.shutdown(wait=True)
+        store.close()
+        query_cache.flush()
+
     # Resumen
     print("\n" + "="*80)
     print("RESUMEN DE REINTENTOS")
@@ -442,7 +1327,7 @@ def retry_failed_codes(excel_path: str, api_key: str, result_json_path: str, mod
     print(f"Aún con error: {retry_count - success_count}")
     
     # Estadísticas finales
-    final_results = [results_dict[i] for i in range(len(results_dict))]
+    final_results = store.results
     print(f"\nEstadísticas finales:")
     print(f"  Total de registros: {len(final_results)}")
     print(f"  Exitosos: {sum(1 for r in final_results if r.get('error') is None)}")
@@ -451,6 +1336,11 @@ def retry_failed_codes(excel_path: str, api_key: str, result_json_path: str, mod
 
 
 def main():
+    import argparse
+
+    from openai_excel_helper import OpenAIExcelProcessor
+    from config import get_api_key
+
     parser = argparse.ArgumentParser(
         description="CLI para procesar archivos Excel con OpenAI",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -513,6 +1403,12 @@ Ejemplos de uso:
         action="store_true",
         help="Reintentar procesar los códigos que tuvieron error en result.json"
     )
+
+    mode_group.add_argument(
+        "--compact",
+        action="store_true",
+        help="Materializar result.json desde la bitácora result.jsonl"
+    )
     
     parser.add_argument(
         "--codes-file",
@@ -539,8 +1435,20 @@ Ejemplos de uso:
         "--max-workers",
         "-w",
         type=int,
-        default=8,
-        help="Número de peticiones paralelas por lote para --process-codes (por defecto: 8, límite TPM: 1M)"
+        default=32,
+        help="Número de peticiones paralelas para --process-codes (por defecto: 32; el límite de 1M TPM lo regula un token bucket)"
+    )
+    
+    parser.add_argument(
+        "--legacy-threads",
+        action="store_true",
+        help="Usar la ruta clásica con hilos en vez de asyncio para --process-codes"
+    )
+    
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Usar la Batch API de OpenAI para --process-codes (offline, ~50%% más barato, hasta 24h)"
     )
     
     args = parser.parse_args()
@@ -596,6 +1504,20 @@ Ejemplos de uso:
             print(f"❌ Error: {e}")
             sys.exit(1)
     
+    elif args.process_codes and args.batch:
+        # Procesar códigos vía Batch API (offline)
+        try:
+            process_codes_batch(
+                excel_path=args.excel_file,
+                api_key=api_key,
+                txt_path=args.codes_file,
+                model=args.model,
+                output_path=args.output
+            )
+        except Exception as e:
+            print(f"❌ Error: {e}")
+            sys.exit(1)
+
     elif args.process_codes:
         # Procesar códigos desde archivo
         try:
@@ -605,37 +1527,33 @@ Ejemplos de uso:
                 txt_path=args.codes_file,
                 model=args.model,
                 output_path=args.output,
-                max_workers=args.max_workers
+                max_workers=args.max_workers,
+                use_threads=args.legacy_threads
             )
         except Exception as e:
             print(f"❌ Error: {e}")
             sys.exit(1)
     
+    elif args.compact:
+        # Consolidar la bitácora JSONL en un result.json final
+        compact_results(args.output or args.result_file)
+
     elif args.retry_errors:
         # Reintentar códigos con error
         try:
             # Buscar el archivo result.json
             result_path = args.result_file
             if not os.path.isabs(result_path):
-                # Buscar en resources
-                current_dir = os.path.dirname(os.path.abspath(__file__))
-                parent_dir = os.path.dirname(current_dir)
-                
-                # Intentar diferentes ubicaciones
+                # Intentar diferentes ubicaciones (primera que exista gana)
                 possible_paths = [
                     result_path,
-                    os.path.join(current_dir, result_path),
-                    os.path.join(parent_dir, result_path),
-                    os.path.join(current_dir, 'resources', 'result.json'),
-                    os.path.join(parent_dir, 'resources', 'result.json')
+                    os.path.join(_SRC_DIR, result_path),
+                    os.path.join(_ROOT_DIR, result_path),
+                    os.path.join(_RESOURCES_DIR, 'result.json')
                 ]
-                
-                result_path = None
-                for path in possible_paths:
-                    if os.path.exists(path):
-                        result_path = path
-                        break
-                
+
+                result_path = next((p for p in possible_paths if os.path.exists(p)), None)
+
                 if not result_path:
                     print(f"❌ Error: No se encontró el archivo result.json")
                     print(f"   Ubicaciones buscadas:")
@@ -668,228 +1586,3 @@ Ejemplos de uso:
 
 if __name__ == "__main__":
     main()
-
-
-if __name__ == "__main__":
-    main()
-
-
-
-def ejemplo_multiples_consultas():
-    """
-    Ejemplo 2: Múltiples consultas manteniendo el contexto
-    """
-    print("\n" + "="*80)
-    print("EJEMPLO 2: Múltiples Consultas con Contexto")
-    print("="*80)
-    
-    # Obtener API key desde .env o variable de entorno
-    API_KEY = get_api_key()
-    if not API_KEY:
-        print("❌ Error: No se encontró API_KEY. Configúrala en .env o como variable de entorno.")
-        return
-    
-    excel_path = "datos.xlsx"
-    
-    # Crear un procesador
-    processor = OpenAIExcelProcessor(API_KEY, model="gpt-4o")
-    
-    # Subir el archivo (solo una vez)
-    file_id = processor.upload_excel_file(excel_path)
-    print(f"Archivo subido con ID: {file_id}")
-    
-    # Primera consulta
-    result1 = processor.query_excel(
-        "Dame un resumen general del contenido del archivo"
-    )
-    if result1["success"]:
-        print(f"\n1. {result1['response']}\n")
-    
-    # Segunda consulta (mantiene el contexto)
-    result2 = processor.query_excel(
-        "¿Cuáles son las columnas más importantes?"
-    )
-    if result2["success"]:
-        print(f"\n2. {result2['response']}\n")
-    
-    # Tercera consulta (sigue manteniendo el contexto)
-    result3 = processor.query_excel(
-        "¿Hay algún dato faltante o inconsistente?"
-    )
-    if result3["success"]:
-        print(f"\n3. {result3['response']}\n")
-    
-    # Ver el historial completo
-    print("\n" + "-"*80)
-    print("Historial de conversación:")
-    print("-"*80)
-    for msg in processor.get_conversation_history():
-        print(f"\n{msg['role'].upper()}: {msg['content'][:100]}...")
-
-
-def ejemplo_extraccion_estructurada():
-    """
-    Ejemplo 3: Extracción de datos estructurados según un schema
-    """
-    print("\n" + "="*80)
-    print("EJEMPLO 3: Extracción de Datos Estructurados")
-    print("="*80)
-    
-    # Obtener API key desde .env o variable de entorno
-    API_KEY = get_api_key()
-    if not API_KEY:
-        print("❌ Error: No se encontró API_KEY. Configúrala en .env o como variable de entorno.")
-        return
-    
-    excel_path = "datos.xlsx"
-    
-    # Definir el schema de datos que queremos extraer
-    schema = {
-        "type": "object",
-        "required": ["productos", "total_ventas", "fecha_reporte"],
-        "properties": {
-            "productos": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "nombre": {"type": "string"},
-                        "cantidad": {"type": "integer"},
-                        "precio": {"type": "number"}
-                    }
-                }
-            },
-            "total_ventas": {
-                "type": "number",
-                "description": "Suma total de todas las ventas"
-            },
-            "fecha_reporte": {
-                "type": "string",
-                "description": "Fecha del reporte en formato YYYY-MM-DD"
-            }
-        }
-    }
-    
-    instructions = """
-Analiza este archivo Excel de ventas y extrae:
-- Lista de productos con nombre, cantidad y precio
-- Total de ventas
-- Fecha del reporte (si está disponible)
-
-Asegúrate de que el JSON cumpla con el schema proporcionado.
-"""
-    
-    result = extract_structured_data(
-        api_key=API_KEY,
-        excel_path=excel_path,
-        schema=schema,
-        instructions=instructions
-    )
-    
-    if result["success"]:
-        import json
-        print("\nDatos extraídos:")
-        print(json.dumps(result["data"], indent=2, ensure_ascii=False))
-    else:
-        print(f"Error: {result['error']}")
-
-
-def ejemplo_uso_similar_distri_hub():
-    """
-    Ejemplo 4: Uso similar al de cli_radicacion.py de Distri-Hub
-    Procesamiento con reintentos y validación
-    """
-    print("\n" + "="*80)
-    print("EJEMPLO 4: Uso Similar a Distri-Hub (con reintentos)")
-    print("="*80)
-    
-    # Obtener API key desde .env o variable de entorno
-    API_KEY = get_api_key()
-    if not API_KEY:
-        print("❌ Error: No se encontró API_KEY. Configúrala en .env o como variable de entorno.")
-        return
-    
-    excel_path = "facturas.xlsx"
-    
-    processor = OpenAIExcelProcessor(API_KEY)
-    
-    # Definir schema para validación (similar al médico)
-    schema = {
-        "type": "object",
-        "required": ["facturas_validas", "facturas_invalidas"],
-        "properties": {
-            "facturas_validas": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "numero_factura": {"type": "string"},
-                        "nit_cliente": {"type": "string"},
-                        "valor": {"type": "number"}
-                    }
-                }
-            },
-            "facturas_invalidas": {
-                "type": "array",
-                "items": {"type": "string"}
-            }
-        }
-    }
-    
-    instructions = """
-Analiza el archivo de facturas y clasifícalas en:
-- Facturas válidas: tienen número, NIT y valor
-- Facturas inválidas: les falta algún dato
-
-Devuelve SOLO el JSON según el schema.
-"""
-    
-    current_try = 0
-    exit_tries = 3
-    data = None
-    
-    while exit_tries > current_try:
-        try:
-            print(f"\nIntento {current_try + 1}/{exit_tries}...")
-            
-            result = extract_structured_data(
-                api_key=API_KEY,
-                excel_path=excel_path,
-                schema=schema,
-                instructions=instructions
-            )
-            
-            if result["success"]:
-                data = result["data"]
-                
-                # Validar que tenga al menos una factura válida
-                if len(data.get("facturas_validas", [])) > 0:
-                    print("✓ Extracción exitosa")
-                    break
-                else:
-                    print("⚠ No se encontraron facturas válidas, reintentando...")
-                    current_try += 1
-                    continue
-            else:
-                print(f"✗ Error: {result['error']}")
-                current_try += 1
-                continue
-                
-        except Exception as e:
-            print(f"✗ Error en el intento: {str(e)}")
-            current_try += 1
-    
-    if data:
-        import json
-        print("\n" + "-"*80)
-        print("RESULTADO FINAL:")
-        print("-"*80)
-        print(json.dumps(data, indent=2, ensure_ascii=False))
-        print(f"\nFacturas válidas: {len(data['facturas_validas'])}")
-        print(f"Facturas inválidas: {len(data['facturas_invalidas'])}")
-    else:
-        print("\n✗ No se pudo procesar el archivo después de varios intentos")
-
-
-if __name__ == "__main__":
-    pass
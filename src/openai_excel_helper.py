@@ -7,14 +7,88 @@ Permite subir archivos Excel y realizar múltiples consultas sobre el contenido
 Basado en la implementación de openai_medical_helper.py de Distri-Hub.
 """
 
+import asyncio
+import functools
 import openai
 import os
 import json
-import base64
-import requests
+import random
+import re
+import threading
+import time
+import httpx
 from typing import Optional, Dict, Any, List
 
 
+# Caché del contenido serializado, compartido entre TODAS las instancias:
+# simple_excel_query crea un procesador nuevo por llamada, así que un caché
+# por instancia no sobrevivía entre consultas. La clave incluye mtime y
+# tamaño, de modo que editar el archivo invalida la entrada sola.
+_CSV_CACHE: Dict[tuple, tuple] = {}
+_CSV_CACHE_LOCK = threading.Lock()
+
+# Tamaño a partir del cual conviene subir el Excel a OpenAI (Files API)
+# y dejar que code_interpreter lo lea del lado del servidor, en vez de
+# inflar cada prompt con el CSV completo
+_LARGE_XLSX_BYTES = 500 * 1024
+
+# Segundo nivel del caché en disco: sobrevive entre procesos y arranques
+# (el catálogo de medicamentos casi nunca cambia, re-parsearlo en cada
+# corrida era trabajo repetido). La clave es el hash del contenido, así
+# que editar el archivo invalida la entrada sola.
+_XLSX_CACHE_DIR = ".xlsx_cache"
+
+# Cercas de markdown alrededor del JSON (```json ... ```), con o sin
+# etiqueta de lenguaje y tolerando espacios/saltos alrededor
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*\n?(.*?)\n?```\s*$", re.DOTALL)
+
+
+class RateLimiter:
+    """
+    Limitador compartido de peticiones y tokens por minuto para las rutas
+    asyncio: dos contadores con refill continuo (RPM y TPM) detrás de un
+    asyncio.Lock. Gastar la cuota acá, antes de disparar, mantiene el
+    paralelismo estable en el techo real de la cuenta en vez de
+    serializarse a golpes de 429.
+    """
+
+    def __init__(self, max_requests_per_minute: int = 500,
+                 max_tokens_per_minute: int = 1_000_000):
+        self.max_requests = float(max_requests_per_minute)
+        self.max_tokens = float(max_tokens_per_minute)
+        self._requests = self.max_requests
+        self._tokens = self.max_tokens
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._requests = min(self.max_requests,
+                             self._requests + elapsed * self.max_requests / 60.0)
+        self._tokens = min(self.max_tokens,
+                           self._tokens + elapsed * self.max_tokens / 60.0)
+        self._updated = now
+
+    async def acquire(self, requests: int = 1, tokens: int = 0):
+        """Bloquea (cediendo el loop) hasta que haya cuota de ambos."""
+        while True:
+            async with self._lock:
+                self._refill()
+                if self._requests >= requests and self._tokens >= tokens:
+                    self._requests -= requests
+                    self._tokens -= tokens
+                    return
+            await asyncio.sleep(0.05)
+
+    async def penalize(self):
+        """Tras un 429, vacía ambos contadores para frenar a todos."""
+        async with self._lock:
+            self._refill()
+            self._requests = min(self._requests, 0.0)
+            self._tokens = min(self._tokens, 0.0)
+
+
 class OpenAIExcelProcessor:
     """
     Clase para procesar archivos Excel con OpenAI.
@@ -36,7 +110,27 @@ class OpenAIExcelProcessor:
         self.num_rows = 0
         self.num_cols = 0
         self.columns = []
+        # CSV pre-serializado del archivo cargado (ver upload_excel_file)
+        self._csv_cache_full = None
+        self._csv_cache_head100 = None
         self.conversation_messages = []
+        # Estado del hilo multi-turno (API de Assistants/Threads): el
+        # historial vive del lado del servidor, acá solo quedan los ids
+        self._assistant_id = None
+        self._thread_id = None
+        # Archivos ya subidos a la Files API, por (ruta, mtime, tamaño),
+        # y el assistant con code_interpreter para consultarlos
+        self._openai_file_ids: Dict[tuple, str] = {}
+        self._ci_assistant_id = None
+        # Un solo cliente (y pool de conexiones keep-alive) para todas
+        # las consultas: instanciar openai.OpenAI por llamada paga un
+        # handshake TCP+TLS (~50-200ms) cada vez
+        self._client = openai.OpenAI(
+            api_key=api_key,
+            http_client=httpx.Client(
+                limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
+            )
+        )
         
     def upload_excel_file(self, excel_path: str) -> str:
         """
@@ -64,12 +158,19 @@ class OpenAIExcelProcessor:
             # Leer el archivo Excel
             self.df = pd.read_excel(excel_path)
             self.file_path = excel_path
-            
+
             # Obtener info básica
             self.num_rows = len(self.df)
             self.num_cols = len(self.df.columns)
             self.columns = list(self.df.columns)
-            
+
+            # Pre-serializar el CSV acá, una sola vez por carga: así
+            # query_excel no paga el to_csv (O(filas*columnas)) al crear
+            # el hilo. Re-subir otro archivo recalcula ambas cadenas.
+            self._csv_cache_head100 = self.df.head(100).to_csv(index=False)
+            self._csv_cache_full = (self._csv_cache_head100 if self.num_rows <= 100
+                                    else self.df.to_csv(index=False))
+
             print(f"Archivo cargado exitosamente:")
             print(f"  - Filas: {self.num_rows}")
             print(f"  - Columnas: {self.num_cols}")
@@ -99,17 +200,24 @@ class OpenAIExcelProcessor:
             raise ValueError("No hay archivo Excel cargado. Usa upload_excel_file() primero.")
         
         try:
-            # Preparar el contenido del Excel (limitar si es muy grande)
-            if self.num_rows > 100:
-                sample_df = self.df.head(100)
-                csv_content = sample_df.to_csv(index=False)
-                content_note = f"\nNOTA: El archivo tiene {self.num_rows} filas, pero solo se muestran las primeras 100 para análisis."
-            else:
-                csv_content = self.df.to_csv(index=False)
-                content_note = ""
-            
-            # Preparar el contexto del archivo
-            file_context = f"""Información del archivo Excel:
+            client = self._client
+
+            # Primera consulta: crear el assistant y el hilo con el
+            # contexto del archivo. El historial queda del lado del
+            # servidor, así cada turno envía SOLO el mensaje nuevo en vez
+            # de re-enviar toda la conversación (que crecía O(N²) en
+            # tokens a lo largo de la sesión).
+            if self._thread_id is None:
+                # Contenido del Excel ya serializado en upload_excel_file
+                # (limitado si es muy grande)
+                if self.num_rows > 100:
+                    csv_content = self._csv_cache_head100
+                    content_note = f"\nNOTA: El archivo tiene {self.num_rows} filas, pero solo se muestran las primeras 100 para análisis."
+                else:
+                    csv_content = self._csv_cache_full
+                    content_note = ""
+
+                file_context = f"""Información del archivo Excel:
 - Total de filas: {self.num_rows}
 - Total de columnas: {self.num_cols}
 - Columnas: {', '.join(self.columns)}
@@ -119,53 +227,68 @@ Contenido (formato CSV):
 {csv_content}
 ```
 {content_note}"""
-            
-            # Añadir el contexto del archivo solo en la primera consulta
-            if len(self.conversation_messages) == 0:
-                self.conversation_messages.append({
+
+                # El assistant se crea UNA vez y se reusa entre resets
+                # (reset_conversation solo recrea el hilo); crear uno por
+                # conversación dejaba assistants huérfanos en el servidor
+                if self._assistant_id is None:
+                    assistant = client.beta.assistants.create(
+                        name="excel-helper",
+                        model=self.model,
+                        instructions="Eres un asistente experto en analizar archivos Excel. "
+                                     "Respondes de manera precisa y estructurada basándote en los datos del archivo. "
+                                     "El usuario te ha proporcionado el contenido completo del archivo."
+                    )
+                    self._assistant_id = assistant.id
+
+                thread = client.beta.threads.create(messages=[{
                     "role": "user",
                     "content": f"{file_context}\n\nArchivo cargado. Estoy listo para responder preguntas."
-                })
+                }])
+                self._thread_id = thread.id
+
+                # Espejo local solo para get_conversation_history()
                 self.conversation_messages.append({
-                    "role": "assistant",
-                    "content": "Entendido. He analizado el archivo Excel. ¿Qué deseas saber?"
+                    "role": "user",
+                    "content": f"{file_context}\n\nArchivo cargado. Estoy listo para responder preguntas."
                 })
-            
-            # Añadir el mensaje del usuario al historial
+
+            # Por turno viaja únicamente el mensaje nuevo
+            client.beta.threads.messages.create(
+                thread_id=self._thread_id, role="user", content=prompt
+            )
             self.conversation_messages.append({
                 "role": "user",
                 "content": prompt
             })
-            
-            # Hacer la consulta con el contexto del archivo
-            client = openai.OpenAI(api_key=self.api_key)
-            
-            response = client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Eres un asistente experto en analizar archivos Excel. "
-                                   "Respondes de manera precisa y estructurada basándote en los datos del archivo. "
-                                   "El usuario te ha proporcionado el contenido completo del archivo."
-                    }
-                ] + self.conversation_messages,
+
+            run = client.beta.threads.runs.create_and_poll(
+                thread_id=self._thread_id,
+                assistant_id=self._assistant_id,
                 temperature=temperature
             )
-            
-            assistant_message = response.choices[0].message.content
-            
-            # Añadir la respuesta al historial
+
+            if run.status != "completed":
+                return {
+                    "success": False,
+                    "error": f"El run terminó en estado '{run.status}'"
+                }
+
+            messages = client.beta.threads.messages.list(
+                thread_id=self._thread_id, order="desc", limit=1
+            )
+            assistant_message = messages.data[0].content[0].text.value
+
             self.conversation_messages.append({
                 "role": "assistant",
                 "content": assistant_message
             })
-            
+
             result = {
                 "success": True,
                 "response": assistant_message,
                 "model": self.model,
-                "total_tokens": response.usage.total_tokens
+                "total_tokens": run.usage.total_tokens if run.usage else 0
             }
             
             return result
@@ -177,80 +300,248 @@ Contenido (formato CSV):
                 "error": str(e)
             }
     
-    def query_with_excel_content(
-            self, excel_path: str, prompt: str, temperature: float = 1,
-            aux_original_code: str = None
-    ) -> Dict[str, Any]:
+    def _excel_csv_info(self, excel_path: str) -> tuple:
         """
-        Procesa un archivo Excel directamente convirtiendo su contenido a texto.
-        Útil para archivos pequeños o consultas únicas.
-        
+        Lee y serializa el Excel a CSV una sola vez por archivo (cacheado
+        en memoria y protegido con lock para uso entre hilos). Con miles
+        de consultas sobre el mismo archivo, el costo de pandas
+        read_excel + to_csv se paga una vez, no por petición.
+
+        Returns:
+            Tupla (csv_content, num_rows, num_cols, columns, content_note)
+        """
+        stat = os.stat(excel_path)
+        cache_key = (os.path.abspath(excel_path), stat.st_mtime_ns, stat.st_size)
+
+        with _CSV_CACHE_LOCK:
+            cached = _CSV_CACHE.get(cache_key)
+            if cached is not None:
+                return cached
+
+            # Caché en disco: en corridas repetidas sobre el mismo
+            # catálogo evita el parseo del xlsx por completo
+            disk_path = self._csv_disk_path(excel_path)
+            info = self._csv_disk_get(disk_path)
+
+            # .xlsx: serialización en streaming con openpyxl read_only
+            # (fila a fila, sin materializar el DataFrame completo)
+            if info is None and excel_path.lower().endswith('.xlsx'):
+                info = self._stream_csv_info(excel_path)
+                if info is not None:
+                    self._csv_disk_put(disk_path, info)
+
+            if info is None:
+                # .xls u openpyxl no disponible / archivo problemático
+                import pandas as pd
+
+                df = pd.read_excel(excel_path)
+
+                num_rows = len(df)
+                num_cols = len(df.columns)
+                columns = list(df.columns)
+
+                # Limitar el contenido si es muy grande (primeras 5000 filas)
+                if num_rows > 5000:
+                    csv_content = df.head(5000).to_csv(index=False)
+                    content_note = (f"\nNOTA: El archivo tiene {num_rows} filas, pero solo "
+                                    f"se muestran las primeras 5000 para análisis.")
+                else:
+                    csv_content = df.to_csv(index=False)
+                    content_note = ""
+
+                info = (csv_content, num_rows, num_cols, columns, content_note)
+                self._csv_disk_put(disk_path, info)
+
+            _CSV_CACHE[cache_key] = info
+            return info
+
+    @staticmethod
+    def _csv_disk_path(excel_path: str) -> str:
+        """
+        Ruta de caché en disco para la serialización CSV de un Excel.
+        La clave incluye el nombre del archivo además del hash del
+        contenido, para poder inspeccionar el directorio a mano.
+        """
+        import hashlib
+
+        with open(excel_path, 'rb') as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+
+        return os.path.join(
+            _XLSX_CACHE_DIR,
+            f"{content_hash}_{os.path.basename(excel_path)}.json"
+        )
+
+    @staticmethod
+    def _csv_disk_get(disk_path: str):
+        """Lee la tupla cacheada del disco, o None si no hay entrada válida."""
+        try:
+            if not os.path.exists(disk_path):
+                return None
+            with open(disk_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            return (entry["csv_content"], entry["num_rows"], entry["num_cols"],
+                    entry["columns"], entry["content_note"])
+        except Exception:
+            # Un caché corrupto nunca debe romper el procesamiento
+            return None
+
+    @staticmethod
+    def _csv_disk_put(disk_path: str, info: tuple):
+        """Guarda la tupla serializada de forma atómica (write + os.replace)."""
+        try:
+            os.makedirs(_XLSX_CACHE_DIR, exist_ok=True)
+            csv_content, num_rows, num_cols, columns, content_note = info
+            entry = {
+                "csv_content": csv_content,
+                "num_rows": num_rows,
+                "num_cols": num_cols,
+                "columns": list(columns),
+                "content_note": content_note
+            }
+            tmp_path = disk_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, disk_path)
+        except Exception as e:
+            print(f"⚠ No se pudo escribir el caché de CSV para {disk_path}: {e}")
+
+    @staticmethod
+    def _stream_csv_info(excel_path: str, max_rows: int = 5000):
+        """
+        Serializa un .xlsx a CSV en streaming (openpyxl read_only +
+        data_only): fila por fila directo al buffer, sin cargar el
+        workbook ni un DataFrame completos en memoria. Devuelve la misma
+        tupla que _excel_csv_info, o None si no se pudo (el llamador cae
+        a pandas).
+        """
+        try:
+            import csv
+            import io
+            from openpyxl import load_workbook
+
+            workbook = load_workbook(excel_path, read_only=True, data_only=True)
+            try:
+                sheet = workbook.active
+                rows_iter = sheet.iter_rows(values_only=True)
+
+                header = next(rows_iter, None)
+                if header is None:
+                    return ("", 0, 0, [], "")
+
+                columns = ['' if cell is None else str(cell) for cell in header]
+                num_cols = len(columns)
+
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(columns)
+
+                written = 0
+                for row in rows_iter:
+                    writer.writerow(['' if cell is None else cell for cell in row])
+                    written += 1
+                    if written >= max_rows:
+                        break
+
+                # El total sale de los metadatos de la hoja (max_row), lo
+                # que permite cortar la iteración en max_rows en vez de
+                # recorrer las filas sobrantes solo para contarlas
+                num_rows = max(written, (sheet.max_row or 1) - 1)
+
+                if num_rows > written:
+                    content_note = (f"\nNOTA: El archivo tiene {num_rows} filas, pero solo "
+                                    f"se muestran las primeras {written} para análisis.")
+                else:
+                    content_note = ""
+
+                return (buffer.getvalue(), num_rows, num_cols, columns, content_note)
+            finally:
+                workbook.close()
+        except Exception:
+            return None
+
+    @staticmethod
+    def _prefilter_csv_rows(csv_content: str, prompt: str,
+                            k: int = 50, min_rows: int = 500):
+        """
+        Filtra el CSV serializado a las k filas más afines a la consulta,
+        puntuando cada fila por cuántos tokens del prompt contiene. Las
+        filas elegidas conservan todas las columnas y su orden original.
+
+        Devuelve (csv_filtrado, filas_conservadas), o None si no aplica:
+        archivo chico, prompt sin tokens útiles, o ninguna fila coincide
+        (en ese caso es más seguro mandar el contenido completo).
+        """
+        try:
+            import csv
+            import io
+
+            reader = csv.reader(io.StringIO(csv_content))
+            rows = list(reader)
+            if len(rows) - 1 <= min_rows:
+                return None
+
+            tokens = {t for t in re.findall(r"\w+", prompt.lower()) if len(t) >= 3}
+            if not tokens:
+                return None
+
+            scored = []
+            for idx, row in enumerate(rows[1:]):
+                line = ' '.join(str(cell) for cell in row).lower()
+                score = sum(1 for t in tokens if t in line)
+                if score:
+                    scored.append((-score, idx, row))
+
+            if not scored:
+                return None
+
+            scored.sort()
+            kept = sorted(scored[:k], key=lambda item: item[1])
+
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(rows[0])
+            writer.writerows(row for _, _, row in kept)
+            return (buffer.getvalue(), len(kept))
+        except Exception:
+            # Ante cualquier problema, mejor el contenido completo
+            return None
+
+    def _build_excel_prompt(self, excel_path: str, prompt: str,
+                            prefilter: bool = False) -> str:
+        """
+        Construye el prompt completo con el contenido del Excel embebido.
+        Compartido entre las variantes síncrona y asíncrona de la consulta.
+        La estructura de la respuesta ya no viaja en el texto: la impone
+        _excel_response_format vía response_format=json_schema.
+
         Args:
             excel_path: Ruta al archivo Excel
             prompt: Pregunta o instrucción sobre el archivo
-            temperature: Temperatura para la generación (0-1)
-            
+            prefilter: Recortar catálogos grandes a las filas más afines
+                       a la consulta. SOLO para búsquedas de un código;
+                       las extracciones necesitan el contenido completo.
+
         Returns:
-            Diccionario con la respuesta
+            Prompt completo listo para enviar al modelo
         """
-        if not os.path.exists(excel_path):
-            raise FileNotFoundError(f"Archivo Excel no encontrado: {excel_path}")
-        
-        print(f"Procesando {excel_path} con OpenAI...")
+        # Contenido del Excel serializado una sola vez por archivo
+        csv_content, num_rows, num_cols, columns, content_note = \
+            self._excel_csv_info(excel_path)
 
-        expected_response = {
-            "type": "object",
-            "properties": {
-                "codigo": {
-                    "type": "string",
-                    "description": "Código alfanumérico identificador del elemento",
-                    "pattern": "^[A-Za-z0-9]+$"
-                },
-                    "descripcion": {
-                    "type": "string",
-                    "description": "Descripción alfanumérica del elemento",
-                    "pattern": "^[A-Za-z0-9\\s]+$"
-                },
-                    "original_code": {
-                    "type": "string",
-                    "description": "Código original inmutable",
-                    "const": aux_original_code
-                },
-                    "original_file": {
-                    "type": "string",
-                    "description": "Nombre o ruta del archivo original inmutable",
-                    "const": excel_path
-                }
-            },
-            "required": ["codigo", "descripcion"]
-            }
+        # Pre-filtro de relevancia: para catálogos grandes, mandar solo
+        # las filas más afines a la consulta en vez de las 5000 del tope.
+        # Recorta los tokens de entrada (y el costo/latencia) en >10x sin
+        # quitarle al modelo la coincidencia aproximada dentro del top.
+        if prefilter:
+            filtered = self._prefilter_csv_rows(csv_content, prompt)
+            if filtered is not None:
+                csv_content, kept = filtered
+                content_note = (f"\nNOTA: El archivo tiene {num_rows} filas; se muestran "
+                                f"las {kept} más afines a la consulta (todas las columnas).")
 
-        
-        try:
-            # Leer el archivo Excel con pandas
-            import pandas as pd
-            
-            # Leer el Excel
-            df = pd.read_excel(excel_path)
-            
-            # Convertir a CSV string (más fácil de procesar por la IA)
-            csv_content = df.to_csv(index=False)
-            
-            # Obtener info básica
-            num_rows = len(df)
-            num_cols = len(df.columns)
-            columns = list(df.columns)
-            
-            # Limitar el contenido si es muy grande (primeras 100 filas)
-            if num_rows > 5000:
-                sample_df = df.head(5000)
-                csv_content = sample_df.to_csv(index=False)
-                content_note = f"\nNOTA: El archivo tiene {num_rows} filas, pero solo se muestran las primeras 100 para análisis."
-            else:
-                content_note = ""
-            
-            # Preparar el prompt con el contenido del Excel
-            full_prompt = f"""Analiza el siguiente archivo Excel que tiene {num_rows} filas y {num_cols} columnas.
+        # Preparar el prompt con el contenido del Excel
+        full_prompt = f"""Analiza el siguiente archivo Excel que tiene {num_rows} filas y {num_cols} columnas.
 Columnas: {', '.join(columns)}
 
 Contenido del archivo (formato CSV):
@@ -273,51 +564,437 @@ INSTRUCCIONES IMPORTANTES:
 Pregunta del usuario: {prompt}
 
 Responde basándote en los datos proporcionados. Si buscas un código, indica claramente el valor de la columna A.
+"""
+        return full_prompt
 
-cumpliendo la siguiente estructura de respuesta:
+    def _completion_kwargs(
+            self, full_prompt: str, temperature: float,
+            model: Optional[str], max_tokens: Optional[int],
+            response_format: Optional[Dict[str, Any]],
+            system: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Arma los kwargs para chat.completions.create, aplicando solo los
+        parámetros opcionales que el llamador haya especificado.
+
+        Si el llamador pasa un mensaje `system` propio (byte-estable entre
+        llamadas), OpenAI puede cachear ese prefijo del prompt.
+        """
+        kwargs: Dict[str, Any] = {
+            "model": model or self.model,
+            "temperature": temperature,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": system or (
+                        "Eres un asistente experto en analizar archivos Excel. "
+                        "Respondes de manera precisa y estructurada basándote en los datos del archivo."
+                    )
+                },
+                {
+                    "role": "user",
+                    "content": full_prompt
+                }
+            ]
+        }
 
-{json.dumps(expected_response, indent=2, ensure_ascii=False)}
+        if max_tokens is not None:
+            kwargs["max_tokens"] = max_tokens
 
-"""
-            
-            # Usar la API de OpenAI
-            client = openai.OpenAI(api_key=self.api_key)
-            
-            response = client.chat.completions.create(
-                model=self.model,
-                temperature=temperature,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Eres un asistente experto en analizar archivos Excel. "
-                                   "Respondes de manera precisa y estructurada basándote en los datos del archivo."
-                    },
-                    {
-                        "role": "user",
-                        "content": full_prompt
-                    }
-                ]
+        if response_format is not None:
+            kwargs["response_format"] = response_format
+
+        return kwargs
+
+    def query_prepared_prompt(
+            self, full_prompt: str, temperature: float = 1,
+            model: Optional[str] = None,
+            max_tokens: Optional[int] = None,
+            response_format: Optional[Dict[str, Any]] = None,
+            system: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Envía un prompt ya construido (ver _build_excel_prompt) al modelo.
+        Permite a los llamadores con reintentos construir el prompt una sola
+        vez y reusarlo en cada intento, sin re-leer ni re-serializar el Excel.
+
+        Args:
+            full_prompt: Prompt completo con el contenido del Excel embebido
+            temperature: Temperatura para la generación (0-1)
+            model: Modelo a usar en esta llamada (por defecto self.model)
+            max_tokens: Límite de tokens de salida (opcional)
+            response_format: response_format de OpenAI, p.ej. json_schema (opcional)
+
+        Returns:
+            Diccionario con la respuesta
+        """
+        try:
+            # Cliente compartido del procesador (conexiones keep-alive)
+            response = self._client.chat.completions.create(
+                **self._completion_kwargs(
+                    full_prompt, temperature, model, max_tokens,
+                    response_format, system
+                )
             )
-            
             assistant_message = response.choices[0].message.content
-            
+
             return {
                 "success": True,
                 "response": assistant_message,
-                "model": self.model,
+                "model": response.model,
                 "total_tokens": response.usage.total_tokens
             }
-            
+
+        except (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError):
+            # Errores transitorios (429, timeout, corte de conexión):
+            # propagarlos para que el llamador decida el backoff
+            raise
+        except Exception as e:
+            print(f"Error en la consulta: {e}")
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
+    def upload_file_to_openai(self, excel_path: str) -> str:
+        """
+        Sube el Excel a la Files API (purpose="assistants") una sola vez
+        por contenido: el id se cachea por (ruta, mtime, tamaño), así que
+        consultas repetidas sobre el mismo archivo reusan la subida.
+
+        Returns:
+            file_id del archivo en OpenAI
+        """
+        stat = os.stat(excel_path)
+        cache_key = (os.path.abspath(excel_path), stat.st_mtime_ns, stat.st_size)
+
+        file_id = self._openai_file_ids.get(cache_key)
+        if file_id is None:
+            with open(excel_path, 'rb') as f:
+                uploaded = self._client.files.create(file=f, purpose="assistants")
+            file_id = uploaded.id
+            self._openai_file_ids[cache_key] = file_id
+            print(f"Archivo subido a OpenAI: {file_id}")
+
+        return file_id
+
+    def _query_large_excel(
+            self, excel_path: str, prompt: str, temperature: float = 1,
+            aux_original_code: str = None
+    ) -> Dict[str, Any]:
+        """
+        Consulta un Excel grande sin incrustar su CSV en el prompt: el
+        archivo vive del lado del servidor (Files API) y el modelo lo lee
+        con code_interpreter. En consultas repetidas solo viaja la
+        pregunta, no las miles de filas.
+        """
+        try:
+            client = self._client
+            file_id = self.upload_file_to_openai(excel_path)
+
+            if self._ci_assistant_id is None:
+                assistant = client.beta.assistants.create(
+                    name="excel-helper-ci",
+                    model=self.model,
+                    tools=[{"type": "code_interpreter"}],
+                    instructions="Eres un asistente experto en analizar archivos Excel. "
+                                 "Lee el archivo adjunto con pandas y responde de manera "
+                                 "precisa y estructurada basándote en sus datos."
+                )
+                self._ci_assistant_id = assistant.id
+
+            user_message = f"""Analiza el archivo Excel adjunto.
+
+INSTRUCCIONES IMPORTANTES:
+- Cuando se te pida buscar un medicamento o principio activo, debes buscar en la COLUMNA D
+- NO necesitas una coincidencia EXACTA, busca la descripción más aproximada o similar
+- El CÓDIGO que debes retornar es el que se encuentra en la COLUMNA A de la fila que mejor coincida
+
+Pregunta del usuario: {prompt}
+
+Responde ÚNICAMENTE con un objeto JSON con esta forma:
+{{"codigo": "...", "descripcion": "...", "original_code": {json.dumps(aux_original_code)}, "original_file": {json.dumps(excel_path)}}}"""
+
+            thread = client.beta.threads.create(messages=[{
+                "role": "user",
+                "content": user_message,
+                "attachments": [{
+                    "file_id": file_id,
+                    "tools": [{"type": "code_interpreter"}]
+                }]
+            }])
+
+            run = client.beta.threads.runs.create_and_poll(
+                thread_id=thread.id,
+                assistant_id=self._ci_assistant_id,
+                temperature=temperature
+            )
+
+            if run.status != "completed":
+                return {
+                    "success": False,
+                    "error": f"El run terminó en estado '{run.status}'"
+                }
+
+            messages = client.beta.threads.messages.list(
+                thread_id=thread.id, order="desc", limit=1
+            )
+
+            return {
+                "success": True,
+                "response": messages.data[0].content[0].text.value,
+                "model": self.model,
+                "total_tokens": run.usage.total_tokens if run.usage else 0
+            }
+
+        except Exception as e:
+            print(f"Error en la consulta con archivo adjunto: {e}")
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
+    def query_with_excel_content(
+            self, excel_path: str, prompt: str, temperature: float = 1,
+            aux_original_code: str = None,
+            response_format: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Procesa un archivo Excel directamente convirtiendo su contenido a texto.
+        Útil para archivos pequeños o consultas únicas.
+
+        Args:
+            excel_path: Ruta al archivo Excel
+            prompt: Pregunta o instrucción sobre el archivo
+            temperature: Temperatura para la generación (0-1)
+            response_format: response_format de OpenAI, p.ej. json_schema (opcional)
+
+        Returns:
+            Diccionario con la respuesta
+        """
+        if not os.path.exists(excel_path):
+            raise FileNotFoundError(f"Archivo Excel no encontrado: {excel_path}")
+
+        # Archivos grandes: mejor adjuntarlos vía Files API que inflar
+        # cada prompt con el CSV completo. Solo aplica a la búsqueda de
+        # códigos (response_format por defecto): un response_format del
+        # llamador (p.ej. extracción estructurada) exige un schema que el
+        # run con code_interpreter no puede garantizar
+        if (response_format is None
+                and os.path.getsize(excel_path) > _LARGE_XLSX_BYTES):
+            return self._query_large_excel(excel_path, prompt, temperature,
+                                           aux_original_code)
+
+        print(f"Procesando {excel_path} con OpenAI...")
+
+        # Sin response_format del llamador es una búsqueda de código: el
+        # pre-filtro de filas aplica y el json_schema por defecto también
+        is_lookup = response_format is None
+
+        try:
+            full_prompt = self._build_excel_prompt(excel_path, prompt,
+                                                   prefilter=is_lookup)
+        except Exception as e:
+            print(f"Error procesando {excel_path}: {e}")
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
+        # Por defecto, la estructura de búsqueda de códigos se impone con
+        # response_format=json_schema: JSON garantizado, sin cercas de
+        # markdown ni reintentos por respuestas mal formadas
+        if is_lookup:
+            response_format = _excel_response_format(excel_path, aux_original_code)
+
+        return self.query_prepared_prompt(full_prompt, temperature,
+                                          response_format=response_format)
+
+    async def query_with_excel_content_async(
+            self, excel_path: str, prompt: str, temperature: float = 1,
+            aux_original_code: str = None,
+            client: Optional["openai.AsyncOpenAI"] = None,
+            response_format: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Variante asíncrona de query_with_excel_content usando openai.AsyncOpenAI.
+        Permite despachar varias consultas concurrentes con asyncio.gather.
+
+        Args:
+            excel_path: Ruta al archivo Excel
+            prompt: Pregunta o instrucción sobre el archivo
+            temperature: Temperatura para la generación (0-1)
+            client: Cliente AsyncOpenAI compartido (opcional). Reusar un único
+                    cliente evita el handshake TCP/TLS por cada petición.
+
+        Returns:
+            Diccionario con la respuesta
+        """
+        if not os.path.exists(excel_path):
+            raise FileNotFoundError(f"Archivo Excel no encontrado: {excel_path}")
+
+        # Mismo enrutamiento que la variante síncrona: los archivos
+        # grandes van por la Files API (la llamada es bloqueante, así que
+        # se despacha a un hilo para no frenar el event loop)
+        if (response_format is None
+                and os.path.getsize(excel_path) > _LARGE_XLSX_BYTES):
+            return await asyncio.to_thread(
+                self._query_large_excel, excel_path, prompt, temperature,
+                aux_original_code
+            )
+
+        print(f"Procesando {excel_path} con OpenAI (async)...")
+
+        # Mismo criterio que la variante síncrona
+        is_lookup = response_format is None
+
+        try:
+            full_prompt = self._build_excel_prompt(excel_path, prompt,
+                                                   prefilter=is_lookup)
         except Exception as e:
             print(f"Error procesando {excel_path}: {e}")
             return {
                 "success": False,
                 "error": str(e)
             }
+
+        if is_lookup:
+            response_format = _excel_response_format(excel_path, aux_original_code)
+
+        return await self.query_prepared_prompt_async(full_prompt, temperature, client,
+                                                      response_format=response_format)
+
+    async def query_batch(self, items: List[tuple], max_concurrency: int = 20,
+                          client: Optional["openai.AsyncOpenAI"] = None,
+                          limiter: Optional[RateLimiter] = None) -> List[Dict[str, Any]]:
+        """
+        Despacha varias consultas (excel_path, prompt) en paralelo: un solo
+        cliente AsyncOpenAI y un semáforo que limita las peticiones en
+        vuelo. La carga es puro I/O de red, así que con latencias típicas
+        de 3-5s el throughput escala casi lineal hasta el techo de RPM/TPM.
+        Los errores transitorios se reintentan con el mismo backoff
+        exponencial de las extracciones.
+
+        Args:
+            items: Lista de tuplas (excel_path, prompt)
+            max_concurrency: Máximo de peticiones simultáneas
+            client: Cliente AsyncOpenAI compartido (opcional)
+            limiter: RateLimiter compartido de RPM/TPM (opcional)
+
+        Returns:
+            Lista de resultados en el mismo orden que items
+        """
+        sem = asyncio.Semaphore(max_concurrency)
+        own_client = client is None
+        if client is None:
+            client = openai.AsyncOpenAI(api_key=self.api_key)
+
+        async def _one(excel_path, prompt):
+            async with sem:
+                for attempt in range(1, 4):
+                    try:
+                        if limiter is not None:
+                            # ~4 caracteres por token; el CSV embebido domina
+                            csv_len = len(self._excel_csv_info(excel_path)[0])
+                            est_tokens = (csv_len + len(prompt)) // 4 + 500
+                            await limiter.acquire(1, est_tokens)
+                        return await self.query_with_excel_content_async(
+                            excel_path, prompt, client=client
+                        )
+                    except (openai.RateLimitError, openai.APITimeoutError,
+                            openai.APIConnectionError) as e:
+                        if isinstance(e, openai.RateLimitError) and limiter is not None:
+                            await limiter.penalize()
+                        if attempt == 3:
+                            return {
+                                "success": False,
+                                "error": f"Error transitorio tras 3 intentos: {e}"
+                            }
+                        await asyncio.sleep(_transient_retry_delay(attempt, e))
+                    except Exception as e:
+                        # Falla puntual del ítem (archivo inexistente,
+                        # Excel ilegible): no debe tumbar el resto del
+                        # lote ni descartar respuestas ya pagadas
+                        return {
+                            "success": False,
+                            "error": str(e)
+                        }
+
+        try:
+            return await asyncio.gather(*(_one(p, q) for p, q in items))
+        finally:
+            if own_client:
+                await client.close()
+
+    def query_batch_sync(self, items: List[tuple], max_concurrency: int = 20,
+                         limiter: Optional[RateLimiter] = None) -> List[Dict[str, Any]]:
+        """Envoltura síncrona de query_batch para llamadores sin event loop."""
+        return asyncio.run(self.query_batch(items, max_concurrency, limiter=limiter))
+
+
+    async def query_prepared_prompt_async(
+            self, full_prompt: str, temperature: float = 1,
+            client: Optional["openai.AsyncOpenAI"] = None,
+            model: Optional[str] = None,
+            max_tokens: Optional[int] = None,
+            response_format: Optional[Dict[str, Any]] = None,
+            system: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Variante asíncrona de query_prepared_prompt.
+
+        Args:
+            full_prompt: Prompt completo con el contenido del Excel embebido
+            temperature: Temperatura para la generación (0-1)
+            client: Cliente AsyncOpenAI compartido (opcional)
+            model: Modelo a usar en esta llamada (por defecto self.model)
+            max_tokens: Límite de tokens de salida (opcional)
+            response_format: response_format de OpenAI, p.ej. json_schema (opcional)
+
+        Returns:
+            Diccionario con la respuesta
+        """
+        try:
+            # Usar la API asíncrona de OpenAI (cliente compartido si se proporciona)
+            if client is None:
+                client = openai.AsyncOpenAI(api_key=self.api_key)
+
+            response = await client.chat.completions.create(
+                **self._completion_kwargs(
+                    full_prompt, temperature, model, max_tokens,
+                    response_format, system
+                )
+            )
+
+            assistant_message = response.choices[0].message.content
+
+            return {
+                "success": True,
+                "response": assistant_message,
+                "model": response.model,
+                "total_tokens": response.usage.total_tokens
+            }
+
+        except (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError):
+            # Errores transitorios (429, timeout, corte de conexión):
+            # propagarlos para que el llamador decida el backoff
+            raise
+        except Exception as e:
+            print(f"Error en la consulta: {e}")
+            return {
+                "success": False,
+                "error": str(e)
+            }
     
     def reset_conversation(self):
-        """Reinicia el historial de conversación."""
+        """Reinicia el historial de conversación (y el hilo del servidor)."""
         self.conversation_messages = []
+        if self._thread_id is not None:
+            try:
+                self._client.beta.threads.delete(self._thread_id)
+            except Exception:
+                pass  # el hilo expira solo del lado del servidor
+        self._thread_id = None
         print("Historial de conversación reiniciado.")
     
     def get_conversation_history(self) -> List[Dict[str, str]]:
@@ -357,8 +1034,39 @@ def simple_excel_query(api_key: str, excel_path: str, prompt: str,
     return processor.query_with_excel_content(excel_path, prompt, temperature)
 
 
+async def simple_excel_query_async(api_key: str, excel_path: str, prompt: str,
+                                   model: str = "gpt-5", temperature: float = 1,
+                                   client: Optional["openai.AsyncOpenAI"] = None) -> Dict[str, Any]:
+    """
+    Variante asíncrona de simple_excel_query, para consultar varios
+    archivos en paralelo sin bloquear el event loop:
+
+        sem = asyncio.Semaphore(10)
+        async def consulta(path):
+            async with sem:
+                return await simple_excel_query_async(api_key, path, prompt)
+        resultados = await asyncio.gather(*(consulta(p) for p in paths))
+
+    Args:
+        api_key: Clave API de OpenAI
+        excel_path: Ruta al archivo Excel
+        prompt: Pregunta o instrucción sobre el archivo
+        model: Modelo a utilizar
+        temperature: Temperatura para la generación (0-1)
+        client: Cliente AsyncOpenAI compartido (opcional)
+
+    Returns:
+        Diccionario con la respuesta
+    """
+    processor = OpenAIExcelProcessor(api_key, model)
+    return await processor.query_with_excel_content_async(
+        excel_path, prompt, temperature, client=client
+    )
+
+
 def extract_structured_data(api_key: str, excel_path: str, schema: Dict[str, Any], 
-                           instructions: str = "", model: str = "gpt-4o") -> Dict[str, Any]:
+                           instructions: str = "", model: str = "gpt-4o",
+                           processor: Optional[OpenAIExcelProcessor] = None) -> Dict[str, Any]:
     """
     Extrae datos estructurados de un archivo Excel según un schema JSON.
     Similar a extract_medical_data pero genérico.
@@ -369,6 +1077,9 @@ def extract_structured_data(api_key: str, excel_path: str, schema: Dict[str, Any
         schema: Schema JSON que debe cumplir la respuesta
         instructions: Instrucciones adicionales para la extracción
         model: Modelo a utilizar
+        processor: Procesador compartido (opcional). Pasarlo en bucles de
+                  reintento evita re-crear el procesador y re-serializar
+                  el Excel en cada intento (el CSV queda cacheado).
         
     Returns:
         Diccionario con los datos extraídos o error
@@ -388,32 +1099,597 @@ def extract_structured_data(api_key: str, excel_path: str, schema: Dict[str, Any
         ...     "Extrae el número de filas y nombres de columnas"
         ... )
     """
+    if processor is None:
+        processor = OpenAIExcelProcessor(api_key, model)
+
+    prompt = _build_structured_prompt(instructions)
+    response_format = _structured_response_format(schema)
+
+    # Reintentos con backoff exponencial SOLO para errores transitorios;
+    # un schema que no valida no se reintenta a ciegas, se corrige con el
+    # fix-up acotado de más abajo
+    for attempt in range(1, 4):
+        try:
+            result = processor.query_with_excel_content(
+                excel_path, prompt, temperature=1, response_format=response_format
+            )
+            break
+        except (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError) as e:
+            if attempt == 3:
+                return {"success": False, "error": f"Error transitorio tras 3 intentos: {e}"}
+            delay = _transient_retry_delay(attempt, e)
+            print(f"Error transitorio ({type(e).__name__}), reintento {attempt}/3 en {delay:.1f}s...")
+            time.sleep(delay)
+
+    parsed = _parse_structured_response(result, model)
+    if not parsed["success"]:
+        return parsed
+
+    # Validación local contra el schema: detectar estructura inválida acá
+    # cuesta microsegundos; detectarla después cuesta un KeyError tardío
+    # o una re-extracción completa
+    error_detail = _validate_extracted(schema, parsed["data"])
+    if error_detail is None:
+        return parsed
+
+    # Fix-up acotado: una segunda llamada corta que corrige solo el campo
+    # inválido en vez de repetir toda la extracción
+    fix_result = processor.query_prepared_prompt(
+        _build_fixup_prompt(parsed["data"], error_detail), temperature=0
+    )
+    fixed = _parse_structured_response(fix_result, model)
+    if fixed["success"] and _validate_extracted(schema, fixed["data"]) is None:
+        return fixed
+
+    return {
+        "success": False,
+        "error": f"La respuesta no cumple el schema: {error_detail}",
+        "raw_response": result.get("response")
+    }
+
+
+async def extract_structured_data_async(api_key: str, excel_path: str, schema: Dict[str, Any],
+                                        instructions: str = "", model: str = "gpt-4o",
+                                        client: Optional["openai.AsyncOpenAI"] = None,
+                                        processor: Optional[OpenAIExcelProcessor] = None) -> Dict[str, Any]:
+    """
+    Variante asíncrona de extract_structured_data.
+    Permite procesar varios archivos Excel en paralelo con asyncio.gather.
+
+    Args:
+        api_key: Clave API de OpenAI
+        excel_path: Ruta al archivo Excel
+        schema: Schema JSON que debe cumplir la respuesta
+        instructions: Instrucciones adicionales para la extracción
+        model: Modelo a utilizar
+        client: Cliente AsyncOpenAI compartido (opcional)
+        processor: Procesador compartido (opcional), ver extract_structured_data
+
+    Returns:
+        Diccionario con los datos extraídos o error
+    """
+    if processor is None:
+        processor = OpenAIExcelProcessor(api_key, model)
+
+    prompt = _build_structured_prompt(instructions)
+    response_format = _structured_response_format(schema)
+
+    for attempt in range(1, 4):
+        try:
+            result = await processor.query_with_excel_content_async(
+                excel_path, prompt, temperature=1, client=client,
+                response_format=response_format
+            )
+            break
+        except (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError) as e:
+            if attempt == 3:
+                return {"success": False, "error": f"Error transitorio tras 3 intentos: {e}"}
+            delay = _transient_retry_delay(attempt, e)
+            print(f"Error transitorio ({type(e).__name__}), reintento {attempt}/3 en {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+    parsed = _parse_structured_response(result, model)
+    if not parsed["success"]:
+        return parsed
+
+    error_detail = _validate_extracted(schema, parsed["data"])
+    if error_detail is None:
+        return parsed
+
+    fix_result = await processor.query_prepared_prompt_async(
+        _build_fixup_prompt(parsed["data"], error_detail), 0, client
+    )
+    fixed = _parse_structured_response(fix_result, model)
+    if fixed["success"] and _validate_extracted(schema, fixed["data"]) is None:
+        return fixed
+
+    return {
+        "success": False,
+        "error": f"La respuesta no cumple el schema: {error_detail}",
+        "raw_response": result.get("response")
+    }
+
+
+def extract_structured_data_multi(api_key: str, excel_paths: List[str],
+                                  schema: Dict[str, Any], instructions: str = "",
+                                  model: str = "gpt-4o",
+                                  processor: Optional[OpenAIExcelProcessor] = None) -> Dict[str, Any]:
+    """
+    Extrae datos estructurados de VARIOS archivos Excel en una sola
+    llamada: los archivos van concatenados en el prompt con separadores
+    numerados y la respuesta es una lista con un elemento por archivo.
+    Amortiza el overhead por petición y esquiva el límite de RPM; con
+    archivos chicos (facturas típicas), lotes de ~10-50 funcionan bien.
+
+    Args:
+        api_key: Clave API de OpenAI
+        excel_paths: Rutas de los archivos a procesar en el lote
+        schema: Schema JSON que debe cumplir la extracción de CADA archivo
+        instructions: Instrucciones adicionales para la extracción
+        model: Modelo a utilizar
+        processor: Procesador compartido (opcional)
+
+    Returns:
+        {"success": True, "results": {excel_path: datos}} o error
+    """
+    if processor is None:
+        processor = OpenAIExcelProcessor(api_key, model)
+
+    sections = []
+    for i, excel_path in enumerate(excel_paths):
+        csv_content, num_rows, num_cols, columns, content_note = \
+            processor._excel_csv_info(excel_path)
+        sections.append(
+            f"### ARCHIVO {i}: {os.path.basename(excel_path)} "
+            f"({num_rows} filas, {num_cols} columnas)\n"
+            f"```\n{csv_content}\n```{content_note}"
+        )
+
+    # Lista de resultados por archivo, cada uno con el schema pedido
+    multi_schema = {
+        "type": "object",
+        "required": ["results"],
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "required": ["file_index", "data"],
+                    "properties": {
+                        "file_index": {
+                            "type": "integer",
+                            "description": "Índice del archivo (### ARCHIVO N)"
+                        },
+                        "data": schema
+                    }
+                }
+            }
+        }
+    }
+
+    full_prompt = f"""{instructions}
+
+A continuación hay {len(excel_paths)} archivos Excel serializados como CSV,
+cada uno precedido por un separador "### ARCHIVO N":
+
+{chr(10).join(sections)}
+
+Extrae la información pedida de CADA archivo por separado. Devuelve
+ÚNICAMENTE un JSON con la clave "results": una lista con un elemento por
+archivo (en orden), cada uno con "file_index" y "data".
+"""
+
+    result = processor.query_prepared_prompt(
+        full_prompt, temperature=1, model=model,
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "extraccion_multi", "schema": multi_schema}
+        }
+    )
+
+    parsed = _parse_structured_response(result, model)
+    if not parsed["success"]:
+        return parsed
+
+    results = {}
+    for item in parsed["data"].get("results", []):
+        idx = item.get("file_index")
+        if isinstance(idx, int) and 0 <= idx < len(excel_paths):
+            results[excel_paths[idx]] = item.get("data")
+
+    return {"success": True, "results": results, "model": model}
+
+
+def batch_extract_structured_data(api_key: str, jobs: List[tuple],
+                                  model: str = "gpt-4o") -> Dict[str, Any]:
+    """
+    Versión offline de extract_structured_data sobre varios archivos
+    usando la Batch API de OpenAI: una línea JSONL por archivo, un solo
+    upload y un solo batch. Sin límites de RPM/TPM que esquivar y con
+    ~50% de descuento por token; a cambio los resultados pueden tardar
+    hasta 24h.
+
+    Args:
+        api_key: Clave API de OpenAI
+        jobs: Lista de tuplas (excel_path, schema, instructions)
+        model: Modelo a utilizar
+
+    Returns:
+        {"success": True, "batch_id": ..., "results": {excel_path: resultado}}
+        donde cada resultado tiene la forma de extract_structured_data,
+        o {"success": False, "error": ...} si el batch no terminó bien.
+    """
+    import tempfile
+    import time
+
     processor = OpenAIExcelProcessor(api_key, model)
-    
-    prompt = f"""
-{instructions}
+    client = openai.OpenAI(api_key=api_key)
+
+    # Una petición por archivo, con el mismo body que usaría el modo online
+    request_lines = []
+    paths_by_id = {}
+    for i, (excel_path, schema, instructions) in enumerate(jobs):
+        custom_id = f"extract-{i}-{os.path.basename(excel_path)}"
+        paths_by_id[custom_id] = excel_path
+
+        prompt = _build_structured_prompt(instructions)
+        full_prompt = processor._build_excel_prompt(excel_path, prompt)
+        body = processor._completion_kwargs(
+            full_prompt, 1, model, None, _structured_response_format(schema)
+        )
+        request_lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body
+        }, ensure_ascii=False))
+
+    # El SDK espera un archivo: JSONL temporal que se borra tras subirlo
+    fd, jsonl_path = tempfile.mkstemp(suffix='.batch.jsonl')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(request_lines) + '\n')
+        with open(jsonl_path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose="batch")
+    finally:
+        os.remove(jsonl_path)
+
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"Batch creado: {batch.id} ({len(request_lines)} archivos)")
+
+    # Sondeo con backoff: de 10s hasta 5 min
+    poll_delay = 10.0
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        print(f"Estado del batch: {batch.status} (próximo chequeo en {int(poll_delay)}s)")
+        time.sleep(poll_delay)
+        poll_delay = min(poll_delay * 2, 300.0)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        return {
+            "success": False,
+            "error": f"El batch terminó en estado '{batch.status}'",
+            "batch_id": batch.id
+        }
+
+    # Demultiplexar la salida por custom_id
+    results = {}
+    output_content = client.files.content(batch.output_file_id)
+    for raw in output_content.text.splitlines():
+        raw = raw.strip()
+        if not raw:
+            continue
+        obj = json.loads(raw)
+        excel_path = paths_by_id.get(obj.get("custom_id"))
+        if excel_path is None:
+            continue
 
-Debes responder ÚNICAMENTE con un JSON válido que cumpla con el siguiente schema:
-{json.dumps(schema, indent=2, ensure_ascii=False)}
+        response_body = (obj.get("response") or {}).get("body") or {}
+        error = obj.get("error")
+        if error or not response_body:
+            results[excel_path] = {
+                "success": False,
+                "error": str(error) if error else "Respuesta vacía del batch"
+            }
+            continue
+
+        results[excel_path] = _parse_structured_response({
+            "success": True,
+            "response": response_body["choices"][0]["message"]["content"]
+        }, model)
+
+    return {"success": True, "batch_id": batch.id, "results": results}
+
+
+def submit_excel_batch(api_key: str, jobs: List[tuple],
+                       model: str = "gpt-4o") -> Dict[str, Any]:
+    """
+    Ruta Batch API genérica para consultas de Excel sin urgencia: empaca
+    las consultas en un JSONL, lo sube con purpose="batch" y crea el
+    batch, SIN esperar el resultado. ~50% de descuento por token y un
+    pool de rate limits separado; recoger después con poll_batch.
 
-No incluyas explicaciones adicionales, solo el JSON.
+    Args:
+        api_key: Clave API de OpenAI
+        jobs: Lista de tuplas (excel_path, prompt) o
+              (excel_path, prompt, aux_original_code). Si hay código
+              original, se usa como custom_id de la línea.
+        model: Modelo a utilizar
+
+    Returns:
+        {"success": True, "batch_id": ..., "custom_ids": {custom_id: excel_path}}
+    """
+    import tempfile
+
+    processor = OpenAIExcelProcessor(api_key, model)
+    client = openai.OpenAI(api_key=api_key)
+
+    request_lines = []
+    paths_by_id = {}
+    for i, job in enumerate(jobs):
+        excel_path, prompt = job[0], job[1]
+        aux_original_code = job[2] if len(job) > 2 else None
+        custom_id = aux_original_code or f"query-{i}-{os.path.basename(excel_path)}"
+        paths_by_id[custom_id] = excel_path
+
+        # El mismo body que enviaría query_with_excel_content en línea
+        # (búsqueda de código: con pre-filtro de filas)
+        full_prompt = processor._build_excel_prompt(excel_path, prompt,
+                                                    prefilter=True)
+        body = processor._completion_kwargs(
+            full_prompt, 1, model, None,
+            _excel_response_format(excel_path, aux_original_code)
+        )
+        request_lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body
+        }, ensure_ascii=False))
+
+    fd, jsonl_path = tempfile.mkstemp(suffix='.batch.jsonl')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(request_lines) + '\n')
+        with open(jsonl_path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose="batch")
+    finally:
+        os.remove(jsonl_path)
+
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"Batch creado: {batch.id} ({len(request_lines)} consultas)")
+
+    return {"success": True, "batch_id": batch.id, "custom_ids": paths_by_id}
+
+
+def poll_batch(api_key: str, batch_id: str) -> Dict[str, Any]:
+    """
+    Espera a que termine un batch creado con submit_excel_batch y
+    demultiplexa su salida. Sondea batches.retrieve con backoff
+    exponencial (10s hasta 5 min), así que puede tardar horas.
+
+    Args:
+        api_key: Clave API de OpenAI
+        batch_id: Id devuelto por submit_excel_batch
+
+    Returns:
+        {"success": True, "batch_id": ..., "results": {custom_id: resultado}}
+        donde cada resultado tiene la forma de query_with_excel_content,
+        o {"success": False, "error": ...} si el batch no terminó bien.
+    """
+    import time
+
+    client = openai.OpenAI(api_key=api_key)
+
+    poll_delay = 10.0
+    batch = client.batches.retrieve(batch_id)
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        print(f"Estado del batch: {batch.status} (próximo chequeo en {int(poll_delay)}s)")
+        time.sleep(poll_delay)
+        poll_delay = min(poll_delay * 2, 300.0)
+        batch = client.batches.retrieve(batch_id)
+
+    if batch.status != "completed":
+        return {
+            "success": False,
+            "error": f"El batch terminó en estado '{batch.status}'",
+            "batch_id": batch.id
+        }
+
+    results = {}
+    output_content = client.files.content(batch.output_file_id)
+    for raw in output_content.text.splitlines():
+        raw = raw.strip()
+        if not raw:
+            continue
+        obj = json.loads(raw)
+        custom_id = obj.get("custom_id")
+        if custom_id is None:
+            continue
+
+        response_body = (obj.get("response") or {}).get("body") or {}
+        error = obj.get("error")
+        if error or not response_body:
+            results[custom_id] = {
+                "success": False,
+                "error": str(error) if error else "Respuesta vacía del batch"
+            }
+            continue
+
+        results[custom_id] = {
+            "success": True,
+            "response": response_body["choices"][0]["message"]["content"],
+            "model": response_body.get("model"),
+            "total_tokens": ((response_body.get("usage") or {})
+                             .get("total_tokens", 0))
+        }
+
+    return {"success": True, "batch_id": batch.id, "results": results}
+
+
+def _transient_retry_delay(attempt: int, error: Exception = None) -> float:
+    """
+    Backoff exponencial con jitter para errores transitorios (429,
+    timeouts, cortes de conexión). Si el 429 trajo retry-after, se
+    respeta ese mínimo.
+    """
+    delay = min(30.0, float(2 ** max(0, attempt - 1)))
+
+    if isinstance(error, openai.RateLimitError):
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+
+    return delay + random.uniform(0, 1)
+
+
+@functools.lru_cache(maxsize=32)
+def _compiled_validator(schema_json: str):
+    """
+    Compila (y cachea por schema serializado) un validador local:
+    fastjsonschema si está instalado (compila a código Python), si no
+    jsonschema, y None si no hay ninguno (se omite la validación).
+    """
+    schema = json.loads(schema_json)
+
+    try:
+        import fastjsonschema
+        return fastjsonschema.compile(schema)
+    except ImportError:
+        pass
+
+    try:
+        from jsonschema import Draft202012Validator
+    except ImportError:
+        return None
+
+    validator = Draft202012Validator(schema)
+
+    def _validate(data):
+        errors = sorted(validator.iter_errors(data), key=lambda e: list(e.path))
+        if errors:
+            first = errors[0]
+            path = '/'.join(str(p) for p in first.path) or '(raíz)'
+            raise ValueError(f"{path}: {first.message}")
+        return data
+
+    return _validate
+
+
+def _validate_extracted(schema: Dict[str, Any], data: Any) -> Optional[str]:
+    """Valida `data` contra el schema localmente. Devuelve None si cumple
+    o el detalle del error (campo y motivo) si no."""
+    validator = _compiled_validator(json.dumps(schema, sort_keys=True))
+    if validator is None:
+        return None
+    try:
+        validator(data)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def _build_fixup_prompt(data: Any, error_detail: str) -> str:
+    """Prompt acotado para corregir SOLO el campo inválido, en vez de
+    pagar una re-extracción completa."""
+    return f"""El siguiente JSON extraído no cumple el schema acordado.
+Error de validación: {error_detail}
+
+JSON a corregir:
+{json.dumps(data, ensure_ascii=False)}
+
+Corrige ÚNICAMENTE lo necesario para resolver ese error y devuelve el JSON
+completo corregido. No cambies ningún otro campo ni agregues explicaciones.
 """
-    
-    result = processor.query_with_excel_content(excel_path, prompt, temperature=1)
-    
+
+
+def _build_structured_prompt(instructions: str) -> str:
+    """Prompt de extracción estructurada. El schema ya no viaja en el
+    texto: lo garantiza response_format=json_schema del lado del API."""
+    return f"""
+{instructions}
+
+Devuelve ÚNICAMENTE el objeto JSON con los datos extraídos, sin explicaciones.
+"""
+
+
+@functools.lru_cache(maxsize=256)
+def _excel_response_format(excel_path: str,
+                           aux_original_code: Optional[str] = None) -> Dict[str, Any]:
+    """
+    response_format json_schema para la búsqueda de códigos: garantiza el
+    objeto {codigo, descripcion, original_code, original_file} sin pedirlo
+    en el texto del prompt. Cacheado porque solo varía por archivo y
+    código original, no por consulta.
+    """
+    schema = {
+        "type": "object",
+        "properties": {
+            "codigo": {
+                "type": "string",
+                "description": "Código alfanumérico identificador del elemento",
+                "pattern": "^[A-Za-z0-9]+$"
+            },
+            "descripcion": {
+                "type": "string",
+                "description": "Descripción alfanumérica del elemento",
+                "pattern": "^[A-Za-z0-9\\s]+$"
+            },
+            "original_code": {
+                "type": "string",
+                "description": "Código original inmutable",
+                "const": aux_original_code
+            },
+            "original_file": {
+                "type": "string",
+                "description": "Nombre o ruta del archivo original inmutable",
+                "const": excel_path
+            }
+        },
+        "required": ["codigo", "descripcion"]
+    }
+
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "busqueda_codigo",
+            "schema": schema
+        }
+    }
+
+
+def _structured_response_format(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """response_format json_schema para forzar salida válida en el API."""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "extraccion", "schema": schema}
+    }
+
+
+def _parse_structured_response(result: Dict[str, Any], model: str) -> Dict[str, Any]:
+    """Limpia y parsea la respuesta del modelo como JSON."""
     if not result["success"]:
         return result
-    
+
     try:
-        # Limpiar markdown si está presente
+        # Limpiar cercas de markdown si están presentes (una sola pasada;
+        # también cubre cercas con espacios iniciales que los startswith
+        # encadenados dejaban pasar)
         raw_text = result["response"]
-        if raw_text.startswith("```json"):
-            raw_text = raw_text[7:]
-        if raw_text.startswith("```"):
-            raw_text = raw_text[3:]
-        if raw_text.endswith("```"):
-            raw_text = raw_text[:-3]
-        raw_text = raw_text.strip()
+        fence = _FENCE_RE.match(raw_text)
+        raw_text = fence.group(1) if fence else raw_text.strip()
         
         data = json.loads(raw_text)
         
@@ -10,26 +10,49 @@ import sys
 import os
 import re
 
+try:
+    # Parseo JSON en C, 2-5x más rápido que la stdlib (opcional)
+    import orjson
+except ImportError:
+    orjson = None
 
-def extract_md_code(found_code_str):
+
+# Patrón de códigos MD, compilado una sola vez al cargar el módulo
+_MD_RE = re.compile(r'MD\d{6}')
+
+# A partir de cuántos registros vale la pena la ruta vectorizada con
+# pandas (por debajo, el bucle simple es igual de rápido y más directo)
+_VECTOR_MIN_ROWS = 10000
+
+
+def _parse_found_code(found_code_str):
     """
-    Extrae el código MD del campo found_code.
+    Extrae código y descripción del campo found_code con UN solo parseo.
     Puede estar en formato JSON o como texto plano.
+
+    Returns:
+        Tupla (codigo, descripcion)
     """
     if not found_code_str:
-        return None
-    
+        return None, None
+
     try:
         # Intentar parsear como JSON
         data = json.loads(found_code_str)
-        return data.get('codigo')
+        return data.get('codigo'), data.get('descripcion')
     except (json.JSONDecodeError, TypeError):
-        # Si no es JSON, buscar patrón MD en el texto
-        match = re.search(r'MD\d{6}', found_code_str)
-        if match:
-            return match.group(0)
-    
-    return None
+        # Si no es JSON: buscar patrón MD en el texto y devolver
+        # el texto completo como descripción
+        match = _MD_RE.search(found_code_str)
+        return (match.group(0) if match else None), found_code_str
+
+
+def extract_md_code(found_code_str):
+    """
+    Extrae el código MD del campo found_code.
+    Puede estar en formato JSON o como texto plano.
+    """
+    return _parse_found_code(found_code_str)[0]
 
 
 def extract_description(found_code_str):
@@ -37,18 +60,64 @@ def extract_description(found_code_str):
     Extrae la descripción del campo found_code.
     Puede estar en formato JSON o como texto plano.
     """
-    if not found_code_str:
-        return None
-    
+    return _parse_found_code(found_code_str)[1]
+
+
+def _vectorized_to_csv(results, csv_path, fieldnames):
+    """
+    Ruta vectorizada para archivos grandes: arma un DataFrame, parsea
+    found_code solo en las filas que son JSON y escribe el CSV con
+    df.to_csv (implementado en C). Devuelve False si pandas no está
+    disponible o algo falla, para que el llamador caiga al bucle simple.
+    """
     try:
-        # Intentar parsear como JSON
-        data = json.loads(found_code_str)
-        return data.get('descripcion')
-    except (json.JSONDecodeError, TypeError):
-        # Si no es JSON, devolver el texto completo
-        return found_code_str
-    
-    return None
+        import pandas as pd
+    except ImportError:
+        return False
+
+    try:
+        df = pd.DataFrame(results)
+        for col in ('original_code', 'product_name', 'found_code',
+                    'error', 'original_line'):
+            if col not in df.columns:
+                df[col] = ''
+        if 'tokens_used' not in df.columns:
+            df['tokens_used'] = 0
+
+        found = df['found_code'].fillna('').astype(str)
+
+        # Solo las filas con pinta de JSON pagan json.loads; las que no
+        # parsean se tratan como texto plano, igual que _parse_found_code
+        def _safe_loads(s):
+            try:
+                return json.loads(s)
+            except (json.JSONDecodeError, TypeError):
+                return None
+
+        parsed = found[found.str.startswith('{')].map(_safe_loads)
+        parsed = parsed[parsed.notna()]
+        is_json = found.index.isin(parsed.index)
+
+        df['found_md_code'] = ''
+        df['found_description'] = ''
+        df.loc[is_json, 'found_md_code'] = \
+            parsed.map(lambda d: d.get('codigo') or '')
+        df.loc[is_json, 'found_description'] = \
+            parsed.map(lambda d: d.get('descripcion') or '')
+
+        plain = ~is_json & (found != '')
+        df.loc[plain, 'found_md_code'] = \
+            found[plain].str.extract(f'({_MD_RE.pattern})')[0].fillna('')
+        df.loc[plain, 'found_description'] = found[plain]
+
+        df['tokens_used'] = df['tokens_used'].fillna(0)
+        df['error'] = df['error'].fillna('')
+        df[fieldnames].to_csv(csv_path, index=False, encoding='utf-8')
+        return True
+
+    except Exception as e:
+        print(f"⚠️  Ruta vectorizada falló ({e}), usando el bucle estándar")
+        return False
 
 
 def result_json_to_csv(json_path, csv_path=None):
@@ -68,10 +137,14 @@ def result_json_to_csv(json_path, csv_path=None):
     if csv_path is None:
         csv_path = json_path.replace('.json', '.csv')
     
-    # Leer el JSON
+    # Leer el JSON (orjson trabaja sobre bytes, sin decodificar antes)
     try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            results = json.load(f)
+        if orjson is not None:
+            with open(json_path, 'rb') as f:
+                results = orjson.loads(f.read())
+        else:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                results = json.load(f)
     except Exception as e:
         print(f"❌ Error leyendo {json_path}: {e}")
         return False
@@ -84,35 +157,40 @@ def result_json_to_csv(json_path, csv_path=None):
     
     # Crear el CSV
     try:
-        with open(csv_path, 'w', newline='', encoding='utf-8') as csvfile:
-            fieldnames = [
-                'original_code',
-                'product_name',
-                'found_md_code',
-                'found_description',
-                'tokens_used',
-                'error',
-                'original_line'
-            ]
-            
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            
-            # Procesar cada resultado
-            for result in results:
-                found_code = result.get('found_code', '')
-                
-                row = {
-                    'original_code': result.get('original_code', ''),
-                    'product_name': result.get('product_name', ''),
-                    'found_md_code': extract_md_code(found_code) or '',
-                    'found_description': extract_description(found_code) or '',
-                    'tokens_used': result.get('tokens_used', 0),
-                    'error': result.get('error', ''),
-                    'original_line': result.get('original_line', '')
-                }
-                
-                writer.writerow(row)
+        fieldnames = [
+            'original_code',
+            'product_name',
+            'found_md_code',
+            'found_description',
+            'tokens_used',
+            'error',
+            'original_line'
+        ]
+
+        if (len(results) >= _VECTOR_MIN_ROWS
+                and _vectorized_to_csv(results, csv_path, fieldnames)):
+            # pandas ya escribió el archivo completo
+            pass
+        else:
+            with open(csv_path, 'w', newline='', encoding='utf-8') as csvfile:
+                # Filas posicionales acumuladas y volcadas en un solo
+                # writerows: menos llamadas por fila que DictWriter.writerow
+                rows = []
+                for result in results:
+                    md_code, description = _parse_found_code(result.get('found_code', ''))
+                    rows.append((
+                        result.get('original_code', ''),
+                        result.get('product_name', ''),
+                        md_code or '',
+                        description or '',
+                        result.get('tokens_used', 0),
+                        result.get('error', ''),
+                        result.get('original_line', '')
+                    ))
+
+                writer = csv.writer(csvfile)
+                writer.writerow(fieldnames)
+                writer.writerows(rows)
         
         print(f"✅ CSV generado exitosamente: {csv_path}")
         print(f"📊 Total de registros: {len(results)}")
@@ -131,6 +209,36 @@ def result_json_to_csv(json_path, csv_path=None):
         return False
 
 
+def result_json_to_csv_many(json_paths):
+    """
+    Convierte varios result-*.json en paralelo, un proceso por archivo
+    (el parseo JSON es CPU puro, así que los hilos no ayudan por el GIL).
+    Cada CSV sale junto a su JSON, igual que en la conversión individual.
+
+    Returns:
+        True si todas las conversiones fueron exitosas
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    json_paths = list(json_paths)
+    if len(json_paths) == 1:
+        return result_json_to_csv(json_paths[0])
+
+    workers = min(len(json_paths), os.cpu_count() or 1)
+    print(f"🔀 Convirtiendo {len(json_paths)} archivos con {workers} procesos...")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(result_json_to_csv, json_paths))
+
+    failed = sum(1 for ok in outcomes if not ok)
+    if failed:
+        print(f"❌ {failed} de {len(json_paths)} conversiones fallaron")
+    else:
+        print(f"✅ {len(json_paths)} archivos convertidos")
+
+    return failed == 0
+
+
 def main():
     """
     Función principal del script
@@ -161,7 +269,19 @@ def main():
             sys.exit(1)
     else:
         json_path = sys.argv[1]
-    
+
+        # Patrones glob (p.ej. 'result_*.json'): convertir el lote en
+        # paralelo, un CSV junto a cada JSON
+        if any(ch in json_path for ch in '*?['):
+            import glob
+
+            matches = sorted(glob.glob(json_path))
+            if not matches:
+                print(f"❌ Error: El patrón '{json_path}' no coincide con ningún archivo")
+                sys.exit(1)
+
+            sys.exit(0 if result_json_to_csv_many(matches) else 1)
+
     # Verificar que el archivo existe
     if not os.path.exists(json_path):
         print(f"❌ Error: El archivo '{json_path}' no existe")